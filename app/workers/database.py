@@ -0,0 +1,189 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager, AsyncExitStack
+from metrics import metrics
+
+logger = logging.getLogger()
+
+def engine_options(config):
+    # Keyword arguments for create_async_engine from the "database" config section
+    database = config.get("database", {})
+    return {
+        "pool_size": database.get("pool_size", 8),
+        "max_overflow": database.get("max_overflow", 4),
+        "pool_pre_ping": database.get("pool_pre_ping", True),
+        "pool_recycle": database.get("pool_recycle", 3600),
+        "pool_timeout": database.get("pool_timeout", 30),
+        # Compiled statement cache; the uploader only issues a handful of distinct queries
+        "query_cache_size": database.get("query_cache_size", 500),
+        "connect_args": {"connect_timeout": database.get("connect_timeout", 10)},
+    }
+
+class AdaptiveLimiter:
+    # AIMD limit on concurrent connections: grows by about one per round of
+    # fast queries while it is the bottleneck, shrinks multiplicatively when
+    # queries slow past the target latency or fail
+
+    def __init__(self, initial=4, min_limit=1, max_limit=12, target_latency=0.25, tolerance=2.0, backoff=0.5):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.inflight = 0
+        self.waiters = deque()
+        self.increases = 0
+        self.decreases = 0
+        self.last_decrease = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        database = config.get("database", {})
+        concurrency = database.get("concurrency", {})
+        # No point admitting more than the pool can hand out connections for
+        connections = database.get("pool_size", 8) + database.get("max_overflow", 4)
+        return cls(
+            initial=concurrency.get("initial", min(4, connections)),
+            min_limit=concurrency.get("min", 1),
+            max_limit=concurrency.get("max", connections),
+            target_latency=concurrency.get("target_latency", 0.25),
+            tolerance=concurrency.get("tolerance", 2.0),
+            backoff=concurrency.get("backoff", 0.5),
+        )
+
+    async def acquire(self):
+        if self.inflight < int(self.limit) and not self.waiters:
+            self.inflight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self):
+        self.inflight -= 1
+        self.wake()
+
+    def wake(self):
+        while self.waiters and self.inflight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    def observe(self, latency, error=False):
+        now = time.monotonic()
+        if error or latency > self.target_latency * self.tolerance:
+            # Queries already in flight at the last decrease saw the old limit, so back off once per round
+            if now - latency >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * (self.backoff if error else 0.9))
+                self.decreases += 1
+                self.last_decrease = now
+        elif latency <= self.target_latency and self.inflight >= int(self.limit) - 1:
+            # Only grow while the limit is what is holding callers back
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.increases += 1
+            self.wake()
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "waiting": len(self.waiters),
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+class DatabaseConnection:
+    # One session and transaction, shared by every query in a batch
+
+    def __init__(self, database, session):
+        self.database = database
+        self.session = session
+
+    async def execute(self, statement, params=None, name="query"):
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self.session.execute(statement, params or {}), self.database.query_timeout)
+        except asyncio.TimeoutError:
+            self.database.limiter.observe(time.perf_counter() - start, error=True)
+            metrics.inc("db_query_errors_total", query=name, error="timeout")
+            # The driver may be part way through reading a result, so don't hand it back to the pool
+            await (await self.session.connection()).invalidate()
+            raise
+        except Exception as e:
+            self.database.limiter.observe(time.perf_counter() - start, error=True)
+            metrics.inc("db_query_errors_total", query=name, error=type(e).__name__)
+            raise
+        elapsed = time.perf_counter() - start
+        self.database.limiter.observe(elapsed)
+        metrics.observe("db_query_seconds", elapsed, query=name)
+        return result
+
+class DatabaseBatch:
+    # Checks a connection out on the first query and holds it until the batch
+    # ends, so a fully cached batch never touches the pool
+
+    def __init__(self, database, stack):
+        self.database = database
+        self.stack = stack
+        self.connection = None
+
+    async def execute(self, statement, params=None, name="query"):
+        if self.connection is None:
+            self.connection = await self.stack.enter_async_context(self.database.connect())
+        return await self.connection.execute(statement, params, name)
+
+class Database:
+    # The ISPyB handle the workers share: a sessionmaker plus the adaptive
+    # limiter and per-query timeout every lookup goes through
+
+    def __init__(self, sessionmaker, limiter=None, query_timeout=30):
+        self.sessionmaker = sessionmaker
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter()
+        self.query_timeout = query_timeout
+        metrics.gauge("db_concurrency_limit", lambda: self.limiter.limit)
+        metrics.gauge("db_connections_inflight", lambda: self.limiter.inflight)
+        metrics.gauge("db_connections_waiting", lambda: len(self.limiter.waiters))
+
+    @classmethod
+    def from_config(cls, sessionmaker, config):
+        if isinstance(sessionmaker, cls):
+            return sessionmaker
+        return cls(
+            sessionmaker,
+            AdaptiveLimiter.from_config(config),
+            config.get("database", {}).get("query_timeout", 30),
+        )
+
+    @asynccontextmanager
+    async def connect(self, connection=None):
+        # Reuses the caller's connection when given one, so a batch's lookups share a session
+        if connection is not None:
+            yield connection
+            return
+        with metrics.time("db_connection_wait_seconds"):
+            await self.limiter.acquire()
+        try:
+            async with self.sessionmaker() as session:
+                async with session.begin():
+                    yield DatabaseConnection(self, session)
+        finally:
+            self.limiter.release()
+
+    @asynccontextmanager
+    async def batch(self):
+        async with AsyncExitStack() as stack:
+            yield DatabaseBatch(self, stack)
+
+    def stats(self):
+        return self.limiter.stats()
@@ -0,0 +1,155 @@
+import os
+import time
+import sqlite3
+import logging
+from image_transforms import copy_file
+
+logger = logging.getLogger()
+
+# One store per process and path: pool workers each open their own connection
+stores = dict()
+
+class DerivedStore:
+    # Flipped images and thumbnails already made, keyed by a hash of the source
+    # JPEG plus how they were made, so a re-sent image costs a hash and a copy
+    # rather than a decode. Files live under <path>/<key[:2]>/; sizes and last
+    # use are indexed in SQLite (WAL, shared by the pool workers) and the least
+    # recently used are evicted once the total passes max_bytes
+
+    def __init__(self, path, max_bytes=None, algorithm="sha256", low_watermark=0.9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.algorithm = algorithm
+        self.low_watermark = low_watermark
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        # Running total, so a put doesn't have to sum the whole index
+        self.db.execute("CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)")
+        self.db.execute("INSERT OR IGNORE INTO usage (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM entries")
+
+    @classmethod
+    def from_config(cls, config):
+        # None unless a store is configured
+        store = config.get("derived_store", {})
+        if not store.get("enabled"):
+            return None
+        key = (os.getpid(), store["path"])
+        if key not in stores:
+            stores[key] = cls(store["path"], store.get("max_bytes"), store.get("hash", "sha256"), store.get("low_watermark", 0.9))
+        return stores[key]
+
+    def file_for(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.jpg")
+
+    def restore(self, derivations):
+        # derivations are (key, target) pairs; all or nothing, so a partial
+        # hit still goes through the full transform. The store is only ever an
+        # optimisation, so its own failures count as a miss
+        try:
+            return self.restore_all(derivations)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Derived image store lookup failed, transforming instead: {e!r}")
+            return False
+
+    def restore_all(self, derivations):
+        keys = [key for key, _ in derivations]
+        found = {
+            key for (key,) in self.db.execute(
+                f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(keys))})", keys
+            )
+        }
+        if len(found) < len(set(keys)):
+            return False
+        try:
+            for key, target in derivations:
+                copy_file(self.file_for(key), target)
+        except FileNotFoundError:
+            # Evicted by another worker since the lookup, or removed by hand
+            self.discard(keys)
+            return False
+        self.db.execute(
+            f"UPDATE entries SET last_used = ? WHERE key IN ({','.join('?' * len(keys))})", [time.time()] + keys
+        )
+        return True
+
+    def put(self, derivations):
+        try:
+            self.put_all(derivations)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Could not add derived images to {self.path}: {e!r}")
+
+    def put_all(self, derivations):
+        # Copies each (key, made file) pair in, then evicts down to the low
+        # watermark if the store has grown past max_bytes
+        sizes = dict()
+        for key, made in derivations:
+            path = self.file_for(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            sizes[key] = copy_file(made, tmp)
+            os.replace(tmp, path)
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            replaced = sum(size for (size,) in self.db.execute(
+                f"SELECT size FROM entries WHERE key IN ({','.join('?' * len(sizes))})", list(sizes)
+            ))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)",
+                [(key, size, now) for key, size in sizes.items()],
+            )
+            self.db.execute("UPDATE usage SET bytes = bytes + ?", (sum(sizes.values()) - replaced,))
+            evicted = self.evict()
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.remove(evicted)
+
+    def evict(self):
+        # Runs inside put's transaction; returns the keys whose files to remove
+        (total,) = self.db.execute("SELECT bytes FROM usage").fetchone()
+        if not self.max_bytes or total <= self.max_bytes:
+            return []
+        target = self.max_bytes * self.low_watermark
+        evicted = []
+        freed = 0
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if total - freed <= target:
+                break
+            evicted.append(key)
+            freed += size
+        self.db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+        self.db.execute("UPDATE usage SET bytes = bytes - ?", (freed,))
+        logger.info(f"Evicted {len(evicted)} derived image(s), {freed} bytes, from {self.path}")
+        return evicted
+
+    def discard(self, keys):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            freed = sum(size for (size,) in self.db.execute(
+                f"SELECT size FROM entries WHERE key IN ({','.join('?' * len(keys))})", keys
+            ))
+            self.db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+            self.db.execute("UPDATE usage SET bytes = bytes - ?", (freed,))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.remove(keys)
+
+    def remove(self, keys):
+        for key in keys:
+            try:
+                os.unlink(self.file_for(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        (entries,) = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()
+        (total,) = self.db.execute("SELECT bytes FROM usage").fetchone()
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes}
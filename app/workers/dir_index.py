@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+# Field names match os.stat_result so either can be passed to the readiness checks
+IndexEntry = namedtuple("IndexEntry", "st_mtime st_size is_dir emitted")
+
+# Stats from the latest scan of every holding directory, so readiness checks
+# and sorting reuse them rather than stat'ing each file again
+scanned_stats = dict()
+
+def cached_stat(path):
+    return scanned_stats.get(path)
+
+class DirectoryIndex:
+    # Persisted path -> (mtime, size, is_dir, time handed to a worker or last
+    # re-checked) for one holding directory. A rescan skips entries handed off
+    # or re-checked within retry_interval without a stat; after that, files are
+    # stat'ed once more and only come back if their mtime or size has changed
+
+    def __init__(self, path, index_path=None, retry_interval=300):
+        self.path = path
+        self.index_path = index_path
+        self.retry_interval = retry_interval
+        self.entries = dict()
+        self.load()
+
+    @classmethod
+    def from_config(cls, config):
+        watch = config.get("watch", {})
+        return cls(config["holding_dir"], watch.get("index_path"), watch.get("retry_interval", 300))
+
+    def load(self):
+        if not self.index_path or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                self.entries = {path: IndexEntry(*entry) for path, entry in json.load(f).items()}
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable directory index {self.index_path}: {e}")
+            self.entries = dict()
+
+    def save(self):
+        if not self.index_path:
+            return
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({path: list(entry) for path, entry in self.entries.items()}, f)
+        os.replace(tmp, self.index_path)
+
+    def scan(self, include, entries=None):
+        # Pure, so it can run in a thread against a snapshot; returns the
+        # candidates oldest first and the new index for apply()
+        entries = self.entries if entries is None else entries
+        now = time.time()
+        scanned = dict()
+        candidates = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    if not include(entry.name, is_dir):
+                        continue
+                    known = entries.get(entry.path)
+                    if known and known.emitted and now - known.emitted < self.retry_interval:
+                        scanned[entry.path] = known
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                scanned[entry.path] = IndexEntry(st.st_mtime, st.st_size, is_dir, known.emitted if known else None)
+                # A file handed off and unchanged since is the journal's to finish, not the
+                # scan's (see FormulatrixUploader.unfinished), and isn't stat'ed again for
+                # another retry_interval. Directories still come back: their mtime misses
+                # files settling deeper down
+                if not is_dir and known and known.emitted and (known.st_mtime, known.st_size) == (st.st_mtime, st.st_size):
+                    scanned[entry.path] = known._replace(emitted=now)
+                    continue
+                candidates.append(entry.path)
+        candidates.sort(key=lambda path: scanned[path].st_mtime)
+        return candidates, scanned
+
+    def apply(self, scanned):
+        for path in self.entries.keys() - scanned.keys():
+            scanned_stats.pop(path, None)
+        self.entries = scanned
+        scanned_stats.update(scanned)
+
+    def refresh(self, include):
+        candidates, scanned = self.scan(include)
+        self.apply(scanned)
+        return candidates
+
+    def stat(self, path):
+        return self.entries.get(path)
+
+    def mark_emitted(self, paths):
+        now = time.time()
+        for path in paths:
+            entry = self.entries.get(path)
+            if entry is None:
+                # Only seen through inotify so far; stat it so the next scan sees it as unchanged
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entry = IndexEntry(st.st_mtime, st.st_size, os.path.isdir(path), None)
+            self.entries[path] = entry._replace(emitted=now)
+
+    def handed_off(self, path):
+        # Given to a worker, so a rescan only offers it again if it changes
+        entry = self.entries.get(path)
+        return entry is not None and entry.emitted is not None
+
+    def forget(self, path):
+        # Changed on disk (e.g. an inotify event), so the next scan looks at it again
+        self.entries.pop(path, None)
+        scanned_stats.pop(path, None)
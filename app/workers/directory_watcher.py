@@ -0,0 +1,200 @@
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+from dir_index import DirectoryIndex
+
+logger = logging.getLogger()
+
+IN_CREATE = 0x00000100
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class Inotify:
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = dict()
+
+    def add_watch(self, path, mask=IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if wd in self.watches and name:
+                events.append((os.path.join(self.watches[wd], name), bool(mask & IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class HoldingDirWatcher:
+    # inotify wakes us as soon as entries land, with an os.scandir rescan as the
+    # fallback (the only source on filesystems without inotify, e.g. NFS)
+
+    def __init__(self, path, include, ready, group=None, members=None, resume=None, ignore=None, max_batch=250,
+                 poll_interval=5, settle_interval=1, retry_interval=300, use_inotify=True, index=None):
+        self.path = path
+        self.include = include
+        self.ready = ready
+        self.group = group if group else (lambda path: path)
+        # Every file of a ready unit is emitted with it, even one a scan or
+        # inotify hasn't reported yet (an XML landing just after its image)
+        self.members = members if members else (lambda path: [path])
+        # Paths to look at again on every rescan, beyond what the scan finds
+        # (unfinished work that is unchanged on disk, see FormulatrixUploader.unfinished)
+        self.resume = resume if resume else (lambda: [])
+        # inotify events for paths this returns True for are dropped (our own
+        # claim releases, see WorkClaims.returned)
+        self.ignore = ignore if ignore else (lambda path: False)
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self.settle_interval = settle_interval
+        self.retry_interval = retry_interval
+        self.use_inotify = use_inotify
+        self.inotify = None
+        self.pending = set()
+        # Persisted across restarts, so rescans only pick up new, changed or stale entries
+        self.index = index if index is not None else DirectoryIndex(path, retry_interval=retry_interval)
+        self.wakeup = asyncio.Event()
+        self.stopped = False
+
+    @classmethod
+    def from_config(cls, config, include, ready, group=None, members=None, resume=None, ignore=None):
+        watch = config.get("watch", {})
+        return cls(
+            config["holding_dir"],
+            include,
+            ready,
+            group=group,
+            members=members,
+            resume=resume,
+            ignore=ignore,
+            max_batch=config.get("max_files_in_batch", config["max_files"]),
+            poll_interval=watch.get("poll_interval", 5),
+            settle_interval=watch.get("settle_interval", 1),
+            retry_interval=watch.get("retry_interval", 300),
+            use_inotify=watch.get("inotify", True),
+            index=DirectoryIndex.from_config(config),
+        )
+
+    def start(self):
+        if self.use_inotify:
+            try:
+                self.inotify = Inotify()
+                self.inotify.add_watch(self.path)
+                asyncio.get_running_loop().add_reader(self.inotify.fd, self.on_inotify)
+                logger.info(f"Watching {self.path} with inotify")
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable for {self.path} ({e}), falling back to polling")
+                if self.inotify:
+                    self.inotify.close()
+                self.inotify = None
+        if not self.inotify:
+            logger.info(f"Polling {self.path} every {self.poll_interval}s")
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def close(self):
+        self.index.save()
+        if self.inotify:
+            asyncio.get_running_loop().remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+
+    def on_inotify(self):
+        for path, is_dir in self.inotify.read_events():
+            if self.include(os.path.basename(path), is_dir) and not self.ignore(path):
+                self.pending.add(path)
+                self.index.forget(path)
+        self.wakeup.set()
+
+    def collect_ready(self, candidates):
+        # Runs in a thread; readiness reuses the stats the scan cached
+        gone = []
+        groups = dict()
+        for path in candidates:
+            try:
+                if not self.ready(path):
+                    continue
+            except FileNotFoundError:
+                # A readiness check may stat other files too (an image's XML);
+                # only the candidate itself being missing means it is gone
+                if not os.path.lexists(path):
+                    gone.append(path)
+                continue
+            group = groups.setdefault(self.group(path), [])
+            group.extend(member for member in self.members(path) if member not in group)
+
+        batches = []
+        batch = []
+        for entries in groups.values():
+            if batch and len(batch) + len(entries) > self.max_batch:
+                batches.append(batch)
+                batch = []
+            batch.extend(entries)
+        if batch:
+            batches.append(batch)
+        return batches, gone
+
+    async def batches(self):
+        self.start()
+        last_scan = None
+        try:
+            while not self.stopped:
+                rescan_interval = self.retry_interval if self.inotify else self.poll_interval
+                if last_scan is None or time.monotonic() - last_scan >= rescan_interval:
+                    found, scanned = await asyncio.to_thread(self.index.scan, self.include, dict(self.index.entries))
+                    self.index.apply(scanned)
+                    self.index.save()
+                    self.pending.update(found)
+                    self.pending.update(self.resume())
+                    last_scan = time.monotonic()
+
+                # Oldest first; entries only seen through inotify have no cached stat yet
+                candidates = sorted(self.pending, key=lambda path: getattr(self.index.stat(path), "st_mtime", float("inf")))
+                batches, gone = await asyncio.to_thread(self.collect_ready, candidates)
+                self.pending.difference_update(gone)
+                for batch in batches:
+                    self.pending.difference_update(batch)
+                    self.index.mark_emitted(batch)
+                    yield batch
+
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(
+                        self.wakeup.wait(),
+                        timeout=self.settle_interval if self.pending else self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.close()
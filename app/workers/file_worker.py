@@ -1,57 +1,79 @@
 import os
-import glob
+import time
 from itertools import repeat
 from shared_worker_functions import *
+from metadata_cache import MetadataCache
+from dir_index import cached_stat
+from database import Database
+from plate_geometry import PlateIndex
+from image_pool import ImagePool
+from xml_metadata import stream_xml_records
+from pipeline import Pipeline, iterate
+from work_journal import WorkJournal, DISCOVERED, RESOLVED, TRANSFORMED, PUBLISHED, CLEANED
+from publisher import JobPublisher
+from retry_queue import RetryQueue
+from metrics import metrics
 import asyncio
-from asyncio import Semaphore
-from concurrent.futures import ProcessPoolExecutor
-import xml.etree.ElementTree as ET
-import re
 import tqdm
-import tqdm.asyncio
 from collections import namedtuple
 import logging
 import logging.handlers
+from types import SimpleNamespace
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
 
 logger = logging.getLogger()
 
+xml_datum_with_container = namedtuple("xml_datum_with_container", "record container position sampleid")
+xml_paths_with_id_location = namedtuple("xml_paths_with_id_location", "old_path new_path inspectionId location")
+
 class ZWorker:
-    def __init__(self, config, session):
+    def __init__(self, config, session, cache=None, pool=None, journal=None):
         self.config = config
-        self.session = session
+        self.session = Database.from_config(session, config)
+        self.cache = cache if cache is not None else MetadataCache.from_config(config)
+        self.pool = pool if pool is not None else ImagePool.from_config(config)
+        self.journal = journal if journal is not None else WorkJournal.from_config(config)
+        self.priority = config.get("priority", 10)
+        # Global bound on in-flight transfers across every concurrent process_file call
+        self.transfer_sem = asyncio.Semaphore(config.get("transfer", {}).get("max_concurrent", 32))
         set_logging(config["logging"])
 
     async def process_file(self, date_dirs):
         logger.info(f"Date directories found: {date_dirs}")
+        memo = fs_memo()
         container_dict = self.get_container_dict(date_dirs)            
 
-        with ProcessPoolExecutor() as exe:
-           await asyncio.gather(*(self.get_target_and_move(barcode, container_dict, exe) for barcode in container_dict))    
+        transfer_stats = {"files": 0, "bytes": 0, "failed": 0, "skipped": 0}
+        start = time.time()
+
+        await asyncio.gather(*(self.get_target_and_move(barcode, container_dict, transfer_stats, memo) for barcode in container_dict))
         
         await asyncio.gather(*(rmdir(date_dir) for date_dir in date_dirs))
+        self.journal.flush()
+
+        elapsed = time.time() - start
+        logger.info(f"Z transfer: {transfer_stats}, {transfer_stats['bytes'] / elapsed / 1e6 if elapsed else 0:.1f} MB/s")
+        logger.info(f"Image pool stage timings: {self.pool.stats()}")
 
         return f"Processed dates: {date_dirs}"
 
     def get_container_dict(self,date_dirs):
         container_dir = dict()
         for date_dir in date_dirs:
-            barcode_dirs = glob.glob(os.path.abspath(f"{date_dir}/*/"))
-            for barcode_dir in barcode_dirs:
-                barcode = os.path.basename(os.path.abspath(barcode_dir))
-                container_dir[barcode] = os.path.dirname(barcode_dir)
+            # d_type tells us which entries are directories without a stat each
+            with os.scandir(os.path.abspath(date_dir)) as entries:
+                for entry in entries:
+                    if entry.is_dir() and not entry.name.startswith("."):
+                        container_dir[entry.name] = os.path.abspath(date_dir)
         return container_dir
 
-    # DELETE
-    async def get_container_by_barcode(self, barcode):
-        return {"visit": "2024-test", "year":"2024"}
-
-    async def get_target_and_move(self,barcode, container_dict, exe):
-        container = await retrieve_container_for_barcode(barcode, self.session)
+    async def get_target_and_move(self,barcode, container_dict, transfer_stats, memo):
+        container = await cached_container_for_barcode(barcode, self.session, self.cache)
     
         if not container:
             logger.error(f"Could not find container in database for {barcode}")
-        
-        container = {"visit": "2024-test", "year":"2024"}
+            return
 
         if container["visit"] is None:
             logger.error(f"Container barcode {barcode} has no session")
@@ -59,7 +81,7 @@ class ZWorker:
         else:
             logger.info(f"{barcode} visit directory: {container['visit']}")
         
-        visit_dir = await get_visit_dir(container, self.config)
+        visit_dir = await get_visit_dir(container, self.config, memo)
         
         if not visit_dir:
             logger.error(f"Could not find visit path for container barcode {barcode}")
@@ -67,215 +89,313 @@ class ZWorker:
     
         target_dir = os.path.join(visit_dir, "tmp", barcode)
 
-        if not await make_dirs(target_dir, self.config):
+        if not await make_dirs(target_dir, self.config, memo):
             logger.error(f"Could not make dir: {target_dir} for {barcode}")
             return
 
         src_dir = (f"{container_dict[barcode]}/{barcode}")
-        files = glob.glob(f"{src_dir}/*")
-        logger.info(f"trying to glob.glob({src_dir})")
-        
-        # tasks = []
-        # for i in files:
-        #     loop = asyncio.get_event_loop()
-        #     task = loop.run_in_executor(exe, move_dir, i, target_dir)
-        #     tasks.append(task)
+        files = await run_io(list_files, src_dir)
+        logger.info(f"Listed {len(files)} file(s) in {src_dir}")
 
+        transfer = self.config.get("transfer", {})
+        barcode_sem = asyncio.Semaphore(transfer.get("max_concurrent_per_barcode", 8))
+        checksum = transfer.get("checksum")
 
-        # progress = [await task for task in tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks))]
-        
-        await rmdir(src_dir)
+        # Files already transferred before a restart only need their source removed
+        states = self.journal.states(files)
+
+        async def move(f):
+            state, data = states.get(f, (DISCOVERED, None))
+            if state == TRANSFORMED and data and await run_io(os.path.exists, data["target"]):
+                result = (f, data["target"], 0)
+            else:
+                async with barcode_sem, self.transfer_sem:
+                    try:
+                        result = await self.pool.run(move_dir, f, target_dir, checksum, False, priority=self.priority)
+                    except BrokenProcessPool:
+                        logger.error(f"Image worker died moving {f}, keeping source")
+                        return f, None, 0
+                if not result[1]:
+                    return result
+                self.journal.record(f, "Z", TRANSFORMED, {"target": result[1]})
+            try:
+                await run_io(os.unlink, f)
+            except OSError:
+                logger.error(f"Error deleting image file {f})")
+                return f, None, result[2]
+            self.journal.record(f, "Z", CLEANED)
+            return result
+
+        tasks = [asyncio.ensure_future(move(f)) for f in files]
+        results = [await task for task in tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=barcode)]
+
+        moved = 0
+        for _, new_f, nbytes in results:
+            if new_f:
+                moved += 1
+                transfer_stats["files"] += 1
+                transfer_stats["bytes"] += nbytes
+                metrics.inc("transfer_bytes_total", nbytes)
+                metrics.inc("transfer_files_total", result="moved")
+            elif nbytes:
+                transfer_stats["failed"] += 1
+                metrics.inc("transfer_files_total", result="failed")
+            else:
+                transfer_stats["skipped"] += 1
+                metrics.inc("transfer_files_total", result="skipped")
+
+        # Only remove the source once every file in it has landed
+        if moved == len(files):
+            await rmdir(src_dir)
+        else:
+            logger.info(f"{len(files) - moved} file(s) left in {src_dir}, not removing it yet")
 
 class EFWorker:
 
-    def __init__(self, config, session):
+    def __init__(self, config, session, cache=None, pool=None, publisher=None, journal=None, retry=None):
         self.config = config
-        self.session = session
+        self.session = Database.from_config(session, config)
+        self.cache = cache if cache is not None else MetadataCache.from_config(config)
+        self.pool = pool if pool is not None else ImagePool.from_config(config)
+        self.publisher = publisher if publisher is not None else JobPublisher.from_config(config)
+        self.journal = journal if journal is not None else WorkJournal.from_config(config)
+        self.priority = config.get("priority", 0)
+        self.plates = PlateIndex.from_config(config)
+        # Images parked in nosession/nosample, re-resolved as they fall due
+        self.retry = retry if retry is not None else RetryQueue.from_config(config)
         set_logging(config["logging"])
 
-        credentials = pika.PlainCredentials("guest", "guest")
-        connection = pika.BlockingConnection(pika.ConnectionParameters(
-            'rabbitmq', 5672, "/", credentials))
-        self.channel = connection.channel()
-
-        self.channel.queue_declare(queue="jobs")
-
-        result = self.channel.queue_declare(queue="res")
-        self.callback_queue = result.method.queue
+    def close(self):
+        self.publisher.close()
 
     async def process_file(self, ef_files):
         unhandled_files = []
 
-        jpg_files = [jpg for jpg in ef_files if jpg.split(".")[1] == 'jpg']
-        xml_files = [xml for xml in ef_files if xml.split(".")[1] == 'xml']
-        xml_valid = [xml for xml in xml_files if xml.replace(".xml",".jpg") in jpg_files]
-        
+        # Pair on the stem with a set, rather than a list scan per XML
+        jpg_stems = {os.path.splitext(f)[0] for f in ef_files if os.path.splitext(f)[1] == '.jpg'}
+        xml_files = [xml for xml in ef_files if os.path.splitext(xml)[1] == '.xml']
+        xml_valid = []
         for xml in xml_files:
-            if xml not in xml_valid:
+            if os.path.splitext(xml)[0] in jpg_stems:
+                xml_valid.append(xml)
+            else:
                 logger.error(f"Corresponding image not found for {xml}")
                 unhandled_files.append(xml)
+        # Oldest first, from the scan's cached stats where there are any
+        xml_valid.sort(key=lambda xml: getattr(cached_stat(xml), "st_mtime", 0))
 
-        xml_valid.sort(key=os.path.getmtime, reverse=True)
-        xml_datum = namedtuple("xml_data", "xml inspectionId root nss")
-        xml_data = []
-        unique_inspection_id = set()
-        for xml in xml_valid:
-            tree = ET.parse(xml)
-            root = tree.getroot()
-            ns = root.tag.split("}")[0].strip("{")
-            nss = {"oppf": ns}
-            inspectionId = re.sub("\-.*", "", root.find("oppf:ImagingId", nss).text)
-            logger.info(f"Inspection: {inspectionId} found for {xml}")
-            xml_data.append(xml_datum(xml,inspectionId,root, nss))
-            unique_inspection_id.add(inspectionId)
-
-        sem = Semaphore(50)
-        tasks = [asyncio.create_task(retrieve_container_for_inspectionId(inspectionId, self.session, sem)) for inspectionId in unique_inspection_id]
-        containers = (await asyncio.gather(*tasks))
-        containers_dict = dict()
-
-        for i in containers:
-            for key, value in i.items():
-                containers_dict[key] = value
-
-        xml_datum_with_container = namedtuple("xml_datum_with_container", "xml_datum container")
-        xml_data_with_container = []
-
-        for xml_datum in xml_data:
-            xml_data_with_container.append(
-                xml_datum_with_container(
-                    xml_datum,
-                    containers_dict[xml_datum.inspectionId])
-                )
-        
         n_files = len(xml_files)
         max_files = self.config["max_files"]
 
         if n_files > max_files:
             print("Too many files")
 
+        # Resume from the journal: skip what was published, and re-enter the
+        # pipeline after the last stage each unfinished file completed
+        fresh = []
+        resume_transform = []
+        resume_publish = []
+        states = self.journal.states(xml_valid)
+        for xml in xml_valid:
+            state, data = states.get(xml, (DISCOVERED, None))
+            if state >= PUBLISHED:
+                continue
+            elif state in (RESOLVED, TRANSFORMED) and data:
+                job = xml_paths_with_id_location(xml, data["new_path"], data["inspectionId"], data["location"])
+                (resume_publish if state == TRANSFORMED else resume_transform).append(job)
+            else:
+                fresh.append(xml)
+                if xml not in states:
+                    self.journal.record(xml, "EF", DISCOVERED)
+        if len(fresh) < len(xml_valid):
+            logger.info(f"Journal: {len(xml_valid) - len(fresh) - len(resume_transform) - len(resume_publish)} already published, resuming {len(resume_transform)} at transform and {len(resume_publish)} at publish")
+
+        # Per-call state, as the scheduler may run several batches on this worker at once
+        batch = SimpleNamespace(unique_inspection_id=set(), progress=tqdm.tqdm(total=len(fresh) + len(resume_transform)), fs=fs_memo())
+
+        runs = []
+        if fresh:
+            runs.append((self.build_pipeline(batch), stream_xml_records(fresh, self.pool, self.config.get("xml_pool_threshold", 500)), None))
+        if resume_transform:
+            runs.append((self.build_pipeline(batch), iterate(resume_transform), "transform"))
+        if resume_publish:
+            runs.append((self.build_pipeline(batch), iterate(resume_publish), "publish"))
+        results = await asyncio.gather(*(pipeline.run(source, start=start) for pipeline, source, start in runs))
+        published = [job for result in results for job in result]
+        batch.progress.close()
+        for job in published:
+            self.retry.discard(job.old_path)
+
+        logger.info(f"Published {len(published)} of {len(xml_valid)} images, pipeline stages: {[pipeline.stats for pipeline, _, _ in runs]}")
+        if await self.publisher.flush(self.config.get("rabbitmq", {}).get("flush_timeout", 60)):
+            self.journal.record_many([job.old_path for job in published], "EF", PUBLISHED)
+        else:
+            # Left as transformed, so they are re-sent next run; the stable message_id makes that safe
+            logger.error(f"Timed out waiting for publisher confirms: {self.publisher.stats()}")
+        self.journal.flush()
+        logger.info(f"Publisher: {self.publisher.stats()}")
+        logger.info(f"Metadata cache: {self.cache.stats()}")
+        logger.info(f"Retry queue: {self.retry.stats()}")
+        logger.info(f"Image pool stage timings: {self.pool.stats()}")
+
+        return f"Processed Inspection IDs: [{batch.unique_inspection_id}]"
+
+    def build_pipeline(self, batch):
+        # parse -> resolve -> plan -> transform -> publish, joined by bounded queues
+        # so DB, filesystem and CPU work overlap and memory stays flat per batch
         n_batch = self.config["max_files_in_batch"]
-
-        # Handle checks and queries for valid xml file in async tasks
-        xml_paths_with_id_location = namedtuple("xml_paths_with_id_location", "old_path new_path inspectionId location")
-        sem = Semaphore(100)
-        tasks = [asyncio.create_task(self.handle_file(xml_datum_with_container, xml_paths_with_id_location, sem)) for xml_datum_with_container in xml_data_with_container]
-        results = (await asyncio.gather(*tasks))
+        limits = self.config.get("pipeline", {})
+        pipeline = Pipeline(maxsize=n_batch)
+        pipeline.stage("resolve", partial(self.resolve_records, batch), concurrency=limits.get("resolve", 2), batch_size=n_batch)
+        pipeline.stage("plan", partial(self.plan_file, batch), concurrency=limits.get("plan", 100))
+        pipeline.stage("transform", partial(self.transform_file, batch), concurrency=limits.get("transform", 2 * (self.pool.max_workers or os.cpu_count())))
+        pipeline.stage("publish", self.publish_file, concurrency=limits.get("publish", 1))
+        return pipeline
+
+    async def resolve_records(self, batch, records):
+        valid_records = []
+        for record in records:
+            if not record.inspectionId:
+                logger.error(f"Could not read ImagingId from {record.xml}")
+                continue
+            # The lookups send ids as integers; one bad id must not fail the whole batch
+            if not record.inspectionId.isdecimal():
+                logger.error(f"Invalid ImagingId {record.inspectionId!r} in {record.xml}")
+                metrics.inc("ef_rejected_total", reason="invalid_inspection_id")
+                continue
+            # Rejected before any container or sample query is spent on it
+            if not self.plates.known_drop(record.drop):
+                logger.error(f"Invalid drop {record.drop!r} in {record.xml}")
+                metrics.inc("ef_rejected_total", reason="invalid_drop")
+                continue
+            logger.info(f"Inspection: {record.inspectionId} found for {record.xml}")
+            valid_records.append(record)
+
+        inspection_ids = {record.inspectionId for record in valid_records}
+        batch.unique_inspection_id.update(inspection_ids)
+        # Both lookups share one connection, checked out only if the cache misses
+        async with self.session.batch() as connection:
+            containers_dict = await cached_containers_for_inspectionIds(inspection_ids, self.session, self.cache, connection)
+
+            placed = []
+            unknown_types = set()
+            for record in valid_records:
+                container = containers_dict[record.inspectionId]
+                position = None
+                if container:
+                    if not self.plates.known_type(container["containerType"]):
+                        unknown_types.add((container["containerType"], container["containerId"]))
+                        metrics.inc("ef_rejected_total", reason="unknown_plate_type")
+                        continue
+                    position = self.get_position(record.drop, container["containerType"])
+                    if not position:
+                        logger.error(f"Drop {record.drop} is outside plate type {container['containerType']} for {record.xml}")
+                        metrics.inc("ef_rejected_total", reason="drop_out_of_range")
+                        continue
+                placed.append((record, position))
+            for platetype, containerId in unknown_types:
+                logger.error(f"Unknown plate type {platetype} for container {containerId}")
+
+            container_locations = {
+                (containers_dict[record.inspectionId]["containerId"], str(position))
+                for record, position in placed if position
+            }
+            samples_dict = await cached_samples_for_locations(container_locations, self.session, self.cache, connection)
+
+        resolved = []
+        for record, position in placed:
+            container = containers_dict[record.inspectionId]
+            sampleid = samples_dict.get((container["containerId"], str(position))) if position else None
+            resolved.append(xml_datum_with_container(record, container, position, sampleid))
+        return resolved
+
+    async def transform_file(self, batch, file):
+        try:
+            result = xml_paths_with_id_location(*await self.pool.run(move_file, file.old_path, file.new_path, file.inspectionId, file.location, self.config, priority=self.priority))
+        except BrokenProcessPool:
+            # Left as resolved, so the next run tries it again
+            logger.error(f"Image worker died transforming {file.old_path}")
+            batch.progress.update()
+            return []
+        batch.progress.update()
+        if not result.new_path:
+            return []
+        self.journal.record(result.old_path, "EF", TRANSFORMED)
+        return [result]
+
+    async def publish_file(self, file):
+        await self.publisher.publish(job_payload(file), job_message_id(file))
+        return [file]
+
+    async def plan_file(self, batch, xml_datum_with_container):
+        result = await self.handle_file(xml_datum_with_container, batch.fs)
         # unhandled files do not have a new path assigned
-        unhandled_files.append([result for result in results if not result.new_path])
-        processing_files = [result for result in results if result.new_path]
-
-        tasks = []
-        with ProcessPoolExecutor() as exe:
-            for file in processing_files:
-                loop = asyncio.get_event_loop()
-                task = loop.run_in_executor(exe, move_file, file.old_path, file.new_path, file.inspectionId, file.location, self.config)
-                tasks.append(task)        
-        progress = [await task for task in tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks))]
-        
-        results = [xml_paths_with_id_location(task.result()[0],task.result()[1], task.result()[2], task.result()[3]) for task in tasks]
-
-        unhandled_files.append([result for result in results if not result.new_path])
-        handled_files = [result for result in results if result.new_path]
+        if not result.new_path:
+            return []
+        self.journal.record(result.old_path, "EF", RESOLVED, {"new_path": result.new_path, "inspectionId": result.inspectionId, "location": result.location})
+        return [result]
 
-        for file in handled_files:
-            publish(file, self.channel, self.callback_queue)
+    async def handle_file(self, xml_datum_with_container, memo):
+        record = xml_datum_with_container.record
+        xml = record.xml
+        inspectionid = record.inspectionId
+        container = xml_datum_with_container.container
+        image = xml.replace(".xml",".jpg")
 
+        if not await file_ready_async(xml):
+            return xml_paths_with_id_location(xml,None, inspectionid, None)
 
-        return f"Processed Inspection IDs: [{unique_inspection_id}]"
-
-    async def handle_file(self, xml_datum_with_container, xml_paths_with_id_location, sem):
-        async with sem:
-            xml = xml_datum_with_container.xml_datum.xml
-            inspectionid = xml_datum_with_container.xml_datum.inspectionId
-            root = xml_datum_with_container.xml_datum.root
-            nss = xml_datum_with_container.xml_datum.nss
-            container = xml_datum_with_container.container
-            image = xml.replace(".xml",".jpg")
-
-            if not file_ready(xml):
-                return xml_paths_with_id_location(xml,None)
-
-            if not container:
-                target_dir = f"{self.config['holding_dir']}/nosession"
-                files_target = [image,xml,target_dir]
-                logger.error(f"Could not find container in database for {inspectionid}")
-                move_unhandled(files_target)
-                return xml_paths_with_id_location(xml,None, inspectionid, None)
+        if not container:
+            target_dir = f"{self.config['holding_dir']}/nosession"
+            files_target = [image,xml,target_dir]
+            logger.error(f"Could not find container in database for {inspectionid}")
+            move_unhandled(files_target)
+            self.retry.schedule(f"{target_dir}/{os.path.basename(xml)}", "nosession", ("inspection", inspectionid), previous=xml)
+            return xml_paths_with_id_location(xml,None, inspectionid, None)
 
-            visit_dir = await get_visit_dir(container, self.config)
+        visit_dir = await get_visit_dir(container, self.config, memo)
 
-            if not visit_dir:
-                logger.error(f"No visit directory for {inspectionid}")
-                return xml_paths_with_id_location(xml,None, inspectionid, None)
+        if not visit_dir:
+            logger.error(f"No visit directory for {inspectionid}")
+            return xml_paths_with_id_location(xml,None, inspectionid, None)
 
-            new_path = f"{visit_dir}/imaging/{container['containerId']}/{inspectionid}"
+        new_path = f"{visit_dir}/imaging/{container['containerId']}/{inspectionid}"
 
-            if not await make_dirs(new_path,self.config):
-                logger.error(f"Could not make dir: {target_dir} for {inspectionid}")
-                return xml_paths_with_id_location(xml,None)
+        if not await make_dirs(new_path,self.config, memo):
+            logger.error(f"Could not make dir: {new_path} for {inspectionid}")
+            return xml_paths_with_id_location(xml,None, inspectionid, None)
 
-            position = self.get_position(
-                root.find("oppf:Drop", nss).text,
-                container["containerType"],)
-            
-            if not position:
-                logger.error(f"Could not math drop for {xml}")
-                return xml_paths_with_id_location(xml,None, inspectionid, None)
-                        
-            sampleid = await retrieve_sample_for_container_id_and_location(position, container["containerId"], self.session)
+        position = xml_datum_with_container.position
         
-            if not sampleid:
-                target_dir = f"{self.config['holding_dir']}/nosample"
-                files_target = [image,xml,target_dir]
-                logger.error(f"Couldnt find a blsample for containerid: {container['containerId']}, position: {position}")
-                move_unhandled(files_target)
-                return xml_paths_with_id_location(xml,None, inspectionid, position)
-            else:
-                sampleid = sampleid[0]
-
-            mppx, mppy = self.get_mpp_coords(root, nss)
-            
-            iid = os.path.basename(image) # Meant to be a sql procedure
+        if not position:
+            logger.error(f"Could not math drop for {xml}")
+            return xml_paths_with_id_location(xml,None, inspectionid, None)
+                    
+        sampleid = xml_datum_with_container.sampleid
+    
+        if not sampleid:
+            target_dir = f"{self.config['holding_dir']}/nosample"
+            files_target = [image,xml,target_dir]
+            logger.error(f"Couldnt find a blsample for containerid: {container['containerId']}, position: {position}")
+            move_unhandled(files_target)
+            self.retry.schedule(f"{target_dir}/{os.path.basename(xml)}", "nosample", ("sample", (container["containerId"], str(position))), previous=xml)
+            return xml_paths_with_id_location(xml,None, inspectionid, position)
+
+        mppx, mppy = self.get_mpp_coords(record)
+        
+        iid = os.path.basename(image) # Meant to be a sql procedure
 
-            new_file = f"{new_path}/{iid}"
+        new_file = f"{new_path}/{iid}"
 
-            return xml_paths_with_id_location(xml,new_file, inspectionid, position)
-                    
-    def get_mpp_coords(self, root, nss):
-        mppx = float(
-            root.find("oppf:SizeInMicrons", nss).find("oppf:Width", nss).text
-        ) / float(
-            root.find("oppf:SizeInPixels", nss).find("oppf:Width", nss).text
-        )
-        mppy = float(
-            root.find("oppf:SizeInMicrons", nss).find("oppf:Height", nss).text
-        ) / float(
-            root.find("oppf:SizeInPixels", nss).find("oppf:Height", nss).text
-        )
+        return xml_paths_with_id_location(xml,new_file, inspectionid, position)
+                
+    def get_mpp_coords(self, record):
+        if None in record.microns or None in record.pixels:
+            return None, None
+        mppx = record.microns[0] / record.pixels[0]
+        mppy = record.microns[1] / record.pixels[1]
         return mppx, mppy
 
     def get_position(self, text_position, platetype):
-        well, drop = text_position.split(".")
-
-        drop = int(drop)
-        row = ord(well[0]) - 65
-        col = int(well[1:]) - 1
-
-        # Need to know what type of plate this is to know how many columns its got
-        # This should be in the database, currently in json format embedded in this collection:
-        # http://ispyb.diamond.ac.uk/beta/client/js/modules/shipment/collections/platetypes.js
-        if platetype not in self.config["types"]:
-            #logger.error("Unknown plate type: %s" % platetype)
-            print("Unknown plate type")
-            return
-
-        ty = self.config["types"][platetype]
-
-        # Position is a linear sequence left to right across the plate
-        return (
-            (ty["well_per_row"] * row * ty["drops_per_well"])
-            + (col * ty["drops_per_well"])
-            + (drop - 1)
-            + 1
-        )
\ No newline at end of file
+        # Plate types are compiled from config["types"] at startup, see plate_geometry
+        return self.plates.location(platetype, text_position)
@@ -1,9 +1,48 @@
 from file_worker import EFWorker
 from file_worker import ZWorker
+from directory_watcher import HoldingDirWatcher
+from dir_index import DirectoryIndex
+from image_pool import ImagePool
+from work_claims import WorkClaims
+from shared_worker_functions import pair_ready, dir_ready, list_files
+from work_journal import PUBLISHED
 import asyncio
+import os
+import time
+import logging
+from functools import partial
+
+logger = logging.getLogger()
+
+def ef_entry(name, is_dir):
+    return not is_dir and os.path.splitext(name)[1] in (".jpg", ".xml")
+
+def z_entry(name, is_dir):
+    return is_dir and not name.startswith(".")
+
+ENTRY_FILTERS = {"EF": ef_entry, "Z": z_entry}
+
+def parked_files(path):
+    # XMLs left in a parking dir (nosession/nosample) by earlier runs
+    if not os.path.isdir(path):
+        return []
+    return [f for f in list_files(path) if os.path.splitext(f)[1] == ".xml"]
 
 class FormulatrixUploader():
 
+    def __init__(self, cache=None, pool=None, max_concurrent_jobs=4, journal=None):
+        self.cache = cache
+        self.journal = journal
+        self.max_concurrent_jobs = max_concurrent_jobs
+        # Long-lived so pool workers are spawned once, not once per batch
+        self.pool = pool if pool is not None else ImagePool()
+        self.watchers = []
+        self.workers = []
+        self.retries = []
+        # Per holding dir; None where coordination with other instances is off
+        self.claims = dict()
+        self.heartbeats = []
+
     async def process_job(self, file_list, config, engine):
         worker_type = config["task"]        
         worker = await self.create_worker(worker_type, config, engine)
@@ -12,10 +51,258 @@ class FormulatrixUploader():
         
         return results
     
+    async def run_jobs(self, jobs, engine):
+        # jobs are (work items, config) pairs; EF and Z run side by side, each split
+        # into independent units that share one global concurrency budget
+        budget = asyncio.Semaphore(self.max_concurrent_jobs)
+        start = time.time()
+        results = await asyncio.gather(*(self.run_job(items, config, engine, budget) for items, config in jobs))
+        return {"elapsed": time.time() - start, "jobs": results}
+
+    async def run_job(self, items, config, engine, budget):
+        worker_type = config["task"]
+        worker = await self.create_worker(worker_type, config, engine)
+        units = self.split_work(worker_type, items, config)
+        job_sem = asyncio.Semaphore(config.get("job_concurrency", 2))
+        start = time.time()
+
+        async def run_unit(unit):
+            async with job_sem, budget:
+                unit_start = time.time()
+                claimed = []
+                try:
+                    claimed = await self.claim(worker_type, unit, config)
+                    if claimed:
+                        result, error = await worker.process_file(claimed), None
+                    else:
+                        result, error = "Claimed by another instance", None
+                except Exception as e:
+                    logger.exception(f"{worker_type} unit of {len(unit)} item(s) failed")
+                    result, error = None, repr(e)
+                finally:
+                    await self.release(claimed, config, worker)
+                return {"items": len(unit), "result": result, "error": error, "elapsed": time.time() - unit_start}
+
+        unit_results = await asyncio.gather(*(run_unit(unit) for unit in units))
+        return {
+            "task": worker_type,
+            "units": len(units),
+            "items": len(items),
+            "errors": sum(1 for unit in unit_results if unit["error"]),
+            "elapsed": time.time() - start,
+            "results": unit_results,
+        }
+
+    def split_work(self, worker_type, items, config):
+        if worker_type == 'Z':
+            # Date directories are independent of each other
+            return [[date_dir] for date_dir in items]
+        elif worker_type == 'EF':
+            # Keep each image with its XML, and cap units at the batch size
+            groups = dict()
+            for f in items:
+                groups.setdefault(os.path.splitext(f)[0], []).append(f)
+            max_batch = config.get("max_files_in_batch", config["max_files"])
+            units = []
+            unit = []
+            for files in groups.values():
+                if unit and len(unit) + len(files) > max_batch:
+                    units.append(unit)
+                    unit = []
+                unit.extend(files)
+            if unit:
+                units.append(unit)
+            return units
+        else:
+            raise ValueError(f"Unknown worker type: {worker_type}")
+
     async def create_worker(self, worker_type, config, engine):
         if worker_type == 'Z':
-            return ZWorker(config, engine)
+            worker = ZWorker(config, engine, self.cache, self.pool, journal=self.journal)
         elif worker_type == 'EF':
-            return EFWorker(config, engine)
+            worker = EFWorker(config, engine, self.cache, self.pool, journal=self.journal)
         else:
-            raise ValueError(f"Unknown worker type: {worker_type}")
\ No newline at end of file
+            raise ValueError(f"Unknown worker type: {worker_type}")
+        self.workers.append(worker)
+        return worker
+
+    async def serve(self, configs, engine):
+        # Long-running mode: one persistent worker and watcher per holding directory
+        workers = [(await self.create_worker(config["task"], config, engine), config) for config in configs]
+        tasks = [self.consume(worker, config) for worker, config in workers]
+        tasks += [self.retry(worker, config) for worker, config in workers if config["task"] == 'EF']
+        await asyncio.gather(*tasks)
+
+    async def consume(self, worker, config):
+        watcher = self.create_watcher(config["task"], config)
+        self.watchers.append(watcher)
+        pruning = asyncio.create_task(self.prune(worker, watcher, config))
+        try:
+            for unit in self.split_work(config["task"], self.unfinished(config), config):
+                await self.process_batch(worker, unit, config)
+            async for batch in watcher.batches():
+                await self.process_batch(worker, batch, config)
+        finally:
+            pruning.cancel()
+
+    async def prune(self, worker, watcher, config):
+        # Old journal rows, a batch at a time, so the journal stays the size of
+        # the recent and unfinished work rather than the whole backlog
+        interval = config.get("journal", {}).get("prune_interval", 600)
+        settled = watcher.index.handed_off if config["task"] == 'EF' else None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                worker.journal.prune(settled)
+            except Exception:
+                logger.exception("Failed to prune the work journal")
+
+    async def process_batch(self, worker, batch, config):
+        claimed = []
+        try:
+            claimed = await self.claim(config["task"], batch, config)
+            if claimed:
+                result = await worker.process_file(claimed)
+                logger.info(result)
+        except Exception:
+            logger.exception(f"Failed to process {config['task']} batch of {len(batch)}")
+        finally:
+            await self.release(claimed, config, worker)
+
+    async def retry(self, worker, config):
+        # Parked EF images go back through the pipeline as they fall due, so a
+        # container or sample registered after imaging is picked up without a restart
+        self.retries.append(worker.retry)
+        for reason in ("nosession", "nosample"):
+            parked = await asyncio.to_thread(parked_files, f"{config['holding_dir']}/{reason}")
+            # Sources are kept after upload, so skip what an earlier retry already published
+            states = worker.journal.states(parked)
+            for xml in parked:
+                if states.get(xml, (0,))[0] < PUBLISHED:
+                    worker.retry.schedule(xml, reason, attempts=1)
+        max_batch = config.get("max_files_in_batch", config["max_files"])
+        async for due in worker.retry.batches(max_batch):
+            batch = []
+            for xml, entry in due:
+                image = f"{os.path.splitext(xml)[0]}.jpg"
+                if not (os.path.exists(xml) and os.path.exists(image)):
+                    # Moved or removed by hand, or claimed elsewhere
+                    worker.retry.discard(xml)
+                    continue
+                # The miss is cached, so drop it or the retry never reaches the database
+                if entry.cache_key is not None:
+                    worker.cache.invalidate(*entry.cache_key)
+                batch += [xml, image]
+            if batch:
+                await self.process_batch(worker, batch, config)
+            # Claimed files come back published (retired) or in the holding dir, not where they were parked
+            states = worker.journal.states([xml for xml, _ in due])
+            for xml, _ in due:
+                if not os.path.exists(xml) or states.get(xml, (0,))[0] >= PUBLISHED:
+                    worker.retry.discard(xml)
+            worker.retry.settle(due)
+
+    def create_watcher(self, worker_type, config):
+        if worker_type == 'Z':
+            return HoldingDirWatcher.from_config(config, z_entry, dir_ready, ignore=partial(self.returned, config))
+        elif worker_type == 'EF':
+            return HoldingDirWatcher.from_config(
+                config,
+                ef_entry,
+                pair_ready,
+                group=lambda path: os.path.splitext(path)[0],
+                members=lambda path: [f"{os.path.splitext(path)[0]}.jpg", f"{os.path.splitext(path)[0]}.xml"],
+                resume=lambda: self.unfinished(config, config.get("watch", {}).get("retry_interval", 300)),
+                ignore=partial(self.returned, config))
+        else:
+            raise ValueError(f"Unknown worker type: {worker_type}")
+
+    async def get_claims(self, config):
+        holding_dir = config["holding_dir"]
+        if holding_dir not in self.claims:
+            claims = self.claims[holding_dir] = WorkClaims.from_config(config)
+            if claims is not None:
+                await asyncio.to_thread(claims.start)
+                self.heartbeats.append(asyncio.create_task(claims.run()))
+        return self.claims[holding_dir]
+
+    async def claim(self, worker_type, items, config):
+        # With coordination on, only the items this instance wins are processed here
+        claims = await self.get_claims(config)
+        if claims is None:
+            return items
+        if worker_type == 'Z':
+            return await asyncio.to_thread(claims.claim_children, items)
+        elif worker_type == 'EF':
+            return await asyncio.to_thread(claims.claim_files, items, lambda path: os.path.splitext(path)[0])
+        else:
+            raise ValueError(f"Unknown worker type: {worker_type}")
+
+    async def release(self, items, config, worker):
+        claims = self.claims.get(config["holding_dir"])
+        if claims is None or not items:
+            return
+        if config["task"] == 'EF':
+            # Published pairs are retired; only unfinished ones go back to the holding dir
+            states = worker.journal.states([f for f in items if os.path.splitext(f)[1] == ".xml"])
+            published = {os.path.splitext(xml)[0] for xml, (state, _) in states.items() if state >= PUBLISHED}
+            finished = [f for f in items if os.path.splitext(f)[0] in published]
+            await asyncio.to_thread(claims.retire, finished)
+            items = [f for f in items if os.path.splitext(f)[0] not in published]
+        await asyncio.to_thread(claims.release, items)
+
+    def returned(self, config, path):
+        # Work this instance released lands back in the holding dir; seen as new,
+        # a pair that can't be processed would be claimed and released again forever
+        claims = self.claims.get(config["holding_dir"])
+        return claims is not None and claims.returned(path)
+
+    def unfinished(self, config, retry_interval=None):
+        # EF pairs handed off but never published (a failed batch, a restart,
+        # or released by coordination). Rescans skip them while they are
+        # unchanged, so the journal drives their resume; with retry_interval,
+        # each is offered again at most once per interval.
+        # Z date dirs are rescanned anyway, see DirectoryIndex.scan
+        if config["task"] != 'EF' or self.journal is None:
+            return []
+        holding_dir = os.path.normpath(config["holding_dir"])
+        before = time.time() - retry_interval if retry_interval is not None else None
+        xmls = []
+        files = []
+        for xml in self.journal.unfinished("EF", before=before):
+            image = f"{os.path.splitext(xml)[0]}.jpg"
+            # Parked images are the retry queue's
+            if os.path.normpath(os.path.dirname(xml)) == holding_dir and os.path.exists(xml) and os.path.exists(image):
+                xmls.append(xml)
+                files += [image, xml]
+        if files:
+            self.journal.touch(xmls)
+            logger.info(f"Resuming {len(xmls)} unfinished EF image(s) from the journal")
+        return files
+
+    def scan(self, config):
+        # One-shot listing of a holding directory: one scandir pass, skipping
+        # entries an earlier run already handed off, see DirectoryIndex
+        if config["task"] not in ENTRY_FILTERS:
+            raise ValueError(f"Unknown worker type: {config['task']}")
+        index = DirectoryIndex.from_config(config)
+        return index, index.refresh(ENTRY_FILTERS[config["task"]])
+
+    def stop(self):
+        for watcher in self.watchers:
+            watcher.stop()
+        for retry in self.retries:
+            retry.stop()
+
+    def close(self):
+        for heartbeat in self.heartbeats:
+            heartbeat.cancel()
+        for claims in self.claims.values():
+            if claims is not None:
+                claims.close()
+        for worker in self.workers:
+            if hasattr(worker, "close"):
+                worker.close()
+        self.pool.shutdown()
+        if self.journal is not None:
+            self.journal.close()
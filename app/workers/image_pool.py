@@ -0,0 +1,144 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import defaultdict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from image_transforms import timed_call, warm_worker
+from metrics import metrics
+
+logger = logging.getLogger()
+
+# Imported once by the fork server, so each worker it forks starts with the decoders loaded
+FORKSERVER_PRELOAD = ["image_transforms", "PIL.Image", "PIL.JpegImagePlugin", "PIL.TiffImagePlugin"]
+
+class ImagePool:
+
+    def __init__(self, max_workers=None, start_method=None, jpegtran="jpegtran"):
+        self.max_workers = max_workers
+        # None keeps the platform default. Under "forkserver" workers are forked
+        # from a server that has only imported image_transforms and PIL
+        self.start_method = start_method
+        self.jpegtran = jpegtran
+        self.executor = None
+        # Submissions beyond the CPU budget wait in a priority heap, so EF images
+        # (priority 0) overtake a large Z archive (higher numbers) for the next slot
+        self.slots = 2 * (max_workers or os.cpu_count())
+        self.inflight = 0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.stage_totals = defaultdict(float)
+        self.stage_counts = defaultdict(int)
+        metrics.gauge("image_pool_inflight", lambda: self.inflight)
+        metrics.gauge("image_pool_waiting", lambda: len(self.waiters))
+        metrics.gauge("image_pool_utilisation", lambda: self.inflight / self.slots)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            max_workers=config.get("image_workers"),
+            start_method=config.get("image_start_method"),
+            jpegtran=config.get("jpegtran", "jpegtran"),
+        )
+
+    def start(self):
+        if self.executor is None:
+            context = multiprocessing.get_context(self.start_method)
+            if context.get_start_method() == "forkserver":
+                context.set_forkserver_preload(FORKSERVER_PRELOAD)
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=context,
+                initializer=warm_worker,
+                initargs=(self.jpegtran,),
+            )
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def warm(self):
+        # One no-op per worker, submitted now so every worker starts (and runs
+        # warm_worker) while the caller gets on with scanning or resolving;
+        # await the result before timing anything
+        executor = self.start()
+        return asyncio.gather(*(
+            asyncio.wrap_future(executor.submit(os.getpid)) for _ in range(self.max_workers or os.cpu_count())
+        ))
+
+    async def acquire(self, priority):
+        if self.inflight < self.slots and not self.waiters:
+            self.inflight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        # Hand the slot straight to the most urgent waiter
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.inflight -= 1
+
+    def discard(self, executor):
+        # A worker died (e.g. OOM-killed on a large TIFF), which breaks the whole
+        # executor; drop it so the next start() builds and warms a new one
+        if self.executor is executor:
+            logger.warning("Image worker died; restarting the image pool")
+            metrics.inc("image_pool_restarts")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args, priority=0, retries=1):
+        submitted = time.monotonic()
+        await self.acquire(priority)
+        try:
+            while True:
+                executor = self.start()
+                try:
+                    result, timings, started = await asyncio.get_running_loop().run_in_executor(executor, timed_call, fn, *args)
+                    break
+                except BrokenProcessPool:
+                    self.discard(executor)
+                    # Everything in flight fails with the worker that died; retry on the
+                    # new pool, so only the item that keeps killing workers fails for good
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+        finally:
+            self.release()
+        timings["queue"] = started - submitted
+        timings["total"] = time.monotonic() - submitted
+        for name, elapsed in timings.items():
+            self.stage_totals[name] += elapsed
+            self.stage_counts[name] += 1
+            metrics.observe("image_pool_stage_seconds", elapsed, stage=name)
+        return result
+
+    def stats(self):
+        return {
+            name: {
+                "count": self.stage_counts[name],
+                "total": round(total, 4),
+                "mean": round(total / self.stage_counts[name], 4),
+            }
+            for name, total in self.stage_totals.items()
+        }
+
+    def reset_stats(self):
+        self.stage_totals.clear()
+        self.stage_counts.clear()
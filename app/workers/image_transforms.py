@@ -0,0 +1,265 @@
+import os
+import time
+import shutil
+import errno
+import hashlib
+import logging
+from contextlib import contextmanager
+from collections import defaultdict
+from functools import lru_cache
+from dir_index import cached_stat
+
+# What the image pool's worker processes run. Kept apart from
+# shared_worker_functions so a worker only imports this, and PIL (and
+# subprocess, for jpegtran) on first use or in warm_worker, rather than
+# sqlalchemy, pika and tqdm as well
+
+logger = logging.getLogger()
+
+# Per-process stage timings, filled in by stage() and collected by timed_call()
+stage_timings = defaultdict(float)
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_timings[name] += time.perf_counter() - start
+
+def timed_call(fn, *args):
+    stage_timings.clear()
+    started = time.monotonic()
+    result = fn(*args)
+    return result, dict(stage_timings), started
+
+def warm_worker(jpegtran="jpegtran"):
+    # Pool initializer: load the decoders and find jpegtran once per worker,
+    # before the first image rather than during it
+    from PIL import Image, JpegImagePlugin, TiffImagePlugin
+    Image.preinit()
+    find_executable(jpegtran)
+    return os.getpid()
+
+def transpose_and_save(f, new_f):
+    # Flips every frame: a Z-stack TIFF keeps all its slices, not just the first.
+    # Returns the number of frames written
+    from PIL import Image, ImageSequence
+    with Image.open(f) as im:
+        frames = [frame.transpose(Image.FLIP_TOP_BOTTOM) for frame in ImageSequence.Iterator(im)]
+    frames[0].save(new_f, save_all=True, append_images=frames[1:])
+    return len(frames)
+
+def frame_count(f):
+    from PIL import Image
+    with Image.open(f) as im:
+        return getattr(im, "n_frames", 1)
+
+def stat_ready(st):
+    return time.time() - st.st_mtime > 10 and st.st_size > 0
+
+def file_ready(f):
+    # A ready verdict from the last directory scan still holds; anything else is re-checked
+    st = cached_stat(f)
+    if st is None or not stat_ready(st):
+        st = os.stat(f)
+    return stat_ready(st)
+
+def copy_file(src, dst):
+    # Zero-copy: copy_file_range (server-side on NFS 4.2, reflinks on XFS/btrfs)
+    # then sendfile, so the data never passes through user space
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        use_copy_file_range = hasattr(os, "copy_file_range")
+        while copied < size:
+            try:
+                if use_copy_file_range:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied, copied, copied)
+                else:
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+            except OSError as e:
+                if use_copy_file_range and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    use_copy_file_range = False
+                    continue
+                raise
+            if n == 0:
+                break
+            copied += n
+    return copied
+
+def file_checksum(f, algorithm="sha256"):
+    digest = hashlib.new(algorithm)
+    with open(f, "rb") as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def verify_transfer(f, new_f, flipped, algorithm):
+    from PIL import Image, ImageSequence
+    if flipped:
+        # TIFF flips are lossless, so flipping each frame of the copy back must give the source pixels
+        with Image.open(f) as src, Image.open(new_f) as dst:
+            if getattr(src, "n_frames", 1) != getattr(dst, "n_frames", 1):
+                return False
+            for src_frame, dst_frame in zip(ImageSequence.Iterator(src), ImageSequence.Iterator(dst)):
+                expected = hashlib.new(algorithm, src_frame.tobytes()).hexdigest()
+                if expected != hashlib.new(algorithm, dst_frame.transpose(Image.FLIP_TOP_BOTTOM).tobytes()).hexdigest():
+                    return False
+            return True
+    return file_checksum(f, algorithm) == file_checksum(new_f, algorithm)
+
+def move_dir(f, target_dir, checksum=None, unlink=True):
+    # Returns (source, target or None if not moved, bytes written)
+    if not file_ready(f):
+        logger.info(f"Not moving file {f} yet")
+        return f, None, 0
+
+    new_f = os.path.join(target_dir, os.path.basename(f))
+    old_file, ext = os.path.splitext(f)
+    flipped = ext in (".tif", ".tiff")
+    try:
+        with stage("transfer"):
+            if flipped:
+                frames = transpose_and_save(f,new_f)
+                nbytes = os.stat(new_f).st_size
+            else:
+                nbytes = copy_file(f, new_f)
+        if checksum:
+            with stage("verify"):
+                if not verify_transfer(f, new_f, flipped, checksum):
+                    logger.error(f"Checksum mismatch copying {f} to {new_f}, keeping source")
+                    return f, None, nbytes
+        # Even unverified, never delete a stack whose copy is missing slices
+        if flipped and frame_count(new_f) != frames:
+            logger.error(f"{new_f} has {frame_count(new_f)} frame(s), {f} has {frames}, keeping source")
+            return f, None, nbytes
+    except IOError:
+        logger.error(
+            f"Error flipping/copying image file {f} to {new_f}"
+        )
+        return f, None, 0
+
+    if unlink:
+        try:
+            os.unlink(f)
+        except IOError:
+            logger.error(f"Error deleting image file {f})")
+    return f, new_f, nbytes
+
+def jpeg_options(config):
+    return {
+        "quality": config.get("jpeg_quality", 75),
+        "optimize": config.get("jpeg_optimize", False),
+    }
+
+def draft_thumbnail(image, size):
+    from PIL import Image
+    # Let the JPEG decoder scale down by up to 1/8 instead of decoding full size
+    with stage("thumbnail_decode"):
+        thumb = Image.open(image)
+        thumb.draft("RGB", size)
+        thumb.thumbnail(size)
+    return thumb.transpose(Image.FLIP_TOP_BOTTOM)
+
+@lru_cache(maxsize=None)
+def find_executable(name):
+    return shutil.which(name)
+
+def mcu_aligned(image):
+    from PIL import Image
+    # A vertical flip is only lossless when the height is a whole number of MCU rows
+    with Image.open(image) as im:
+        if im.format != "JPEG":
+            return False
+        mcu_height = 8 * max(layer[2] for layer in im.layer)
+        return im.size[1] % mcu_height == 0
+
+def lossless_flip(image, new_f, config):
+    # jpegtran flips the DCT coefficients directly: no decode, no re-encode, no generation loss
+    jpegtran = find_executable(config.get("jpegtran", "jpegtran"))
+    if not jpegtran or not mcu_aligned(image):
+        return False
+
+    import subprocess
+    command = [jpegtran, "-flip", "vertical", "-perfect", "-copy", "none"]
+    if config.get("jpeg_optimize"):
+        command.append("-optimize")
+    result = subprocess.run(command + ["-outfile", new_f, image], capture_output=True)
+    if result.returncode != 0:
+        logger.warning(f"Lossless flip failed for {image}, falling back to PIL: {result.stderr.decode().strip()}")
+        return False
+    return True
+
+def thumbnails(new_f, config):
+    # (size, path) for each thumbnail to write: thumb_width x thumb_height as
+    # <name>th.jpg, then any extra thumbnail_sizes as <name>th<w>x<h>.jpg
+    if not config.get("save_thumbnail"):
+        return []
+    file, ext = os.path.splitext(new_f)
+    targets = [((config["thumb_width"], config["thumb_height"]), f"{file}th{ext}")]
+    for width, height in config.get("thumbnail_sizes", []):
+        targets.append(((width, height), f"{file}th{width}x{height}{ext}"))
+    return targets
+
+def derivations(digest, new_f, config):
+    # (store key, target) for everything move_file writes. The key includes the
+    # options that change the output, so a config change never serves stale files
+    options = f"q{config.get('jpeg_quality', 75)}{'o' if config.get('jpeg_optimize') else ''}"
+    pairs = [(f"{digest}-flip-{config.get('flip_mode', 'pil')}-{options}", new_f)]
+    for (width, height), path in thumbnails(new_f, config):
+        pairs.append((f"{digest}-th{width}x{height}-{options}{'d' if config.get('thumb_draft') else ''}", path))
+    return pairs
+
+def move_file(xml, new_f, inspectionId, location, config):
+    from PIL import Image
+    from derived_store import DerivedStore
+    image = xml.replace(".xml",".jpg")
+    try:
+        store = DerivedStore.from_config(config)
+        if store is not None:
+            # A re-sent image costs a hash and a copy, checked before any decode
+            with stage("hash"):
+                made = derivations(file_checksum(image, store.algorithm), new_f, config)
+            with stage("store_lookup"):
+                hit = store.restore(made)
+            if hit:
+                # A zero-length stage, so hits show up in the pool's stage counts
+                stage_timings["store_hit"] += 0
+                return xml, new_f, inspectionId, location
+
+        flip = None
+        if config.get("flip_mode") == "lossless":
+            with stage("lossless_flip"):
+                flipped = lossless_flip(image, new_f, config)
+        else:
+            flipped = False
+
+        if not flipped:
+            with stage("decode"):
+                im = Image.open(image)
+                im.load()
+            with stage("flip"):
+                flip = im.transpose(Image.FLIP_TOP_BOTTOM)
+            with stage("encode"):
+                flip.save(new_f, **jpeg_options(config))
+
+        for size, path in thumbnails(new_f, config):
+            with stage("thumbnail"):
+                if flip is None or config.get("thumb_draft"):
+                    thumb = draft_thumbnail(image, size)
+                else:
+                    # Reuse the single decode rather than opening the image again
+                    thumb = flip.copy()
+                    thumb.thumbnail(size)
+                thumb.save(path, **jpeg_options(config))
+
+        if store is not None:
+            with stage("store_put"):
+                store.put(made)
+        #os.unlink(image)
+        #os.unlink(xml) ## Currently, nothing goes 
+        return xml, new_f, inspectionId, location
+    except IOError:
+        logger.error(f"Error flipping/saving image file {image} to {new_f}")
+        return xml, None, inspectionId, location
@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from metrics import metrics
+
+class MetadataCache:
+
+    def __init__(self, max_entries=10000, ttl=300, negative_ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.get("metadata_cache", {})
+        return cls(
+            max_entries=cache_config.get("max_entries", 10000),
+            ttl=cache_config.get("ttl", 300),
+            negative_ttl=cache_config.get("negative_ttl", 60),
+        )
+
+    def get(self, namespace, key):
+        # Returns (found, value); a found value of None is a cached "not found"
+        entry = self.entries.get((namespace, key))
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[(namespace, key)]
+            self.misses += 1
+            metrics.inc("metadata_cache_lookups_total", namespace=namespace, result="miss")
+            return False, None
+        self.entries.move_to_end((namespace, key))
+        self.hits += 1
+        if entry[1] is None:
+            self.negative_hits += 1
+        metrics.inc("metadata_cache_lookups_total", namespace=namespace, result="hit" if entry[1] is not None else "negative_hit")
+        return True, entry[1]
+
+    def set(self, namespace, key, value):
+        ttl = self.negative_ttl if value is None else self.ttl
+        self.entries[(namespace, key)] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end((namespace, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, namespace, key):
+        self.entries.pop((namespace, key), None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,166 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+class Registry:
+    # Counters, gauges and latency histograms keyed by (name, labels). Updated
+    # from the event loop, the fs-io threads and the publisher thread, hence the lock
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.gauge_callbacks = dict()
+        self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge(self, name, callback, **labels):
+        # Sampled when rendered, for values owned elsewhere such as pool occupancy
+        with self.lock:
+            self.gauge_callbacks[(name, tuple(sorted(labels.items())))] = callback
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def sampled_gauges(self):
+        gauges = dict(self.gauges)
+        for key, callback in self.gauge_callbacks.items():
+            try:
+                gauges[key] = callback()
+            except Exception:
+                logger.exception(f"Metric gauge {key[0]} failed")
+        return gauges
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": {format_key(key): value for key, value in self.counters.items()},
+                "gauges": {format_key(key): value for key, value in self.sampled_gauges().items()},
+                "histograms": {
+                    format_key(key): {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": {str(bound): count for bound, count in histogram.cumulative()},
+                    }
+                    for key, histogram in self.histograms.items()
+                },
+            }
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.sampled_gauges())):
+                for name in sorted({key[0] for key in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (key_name, labels), value in values.items():
+                        if key_name == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (key_name, labels), histogram in self.histograms.items():
+                    if key_name != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+def format_key(key):
+    return f"{key[0]}{format_labels(key[1])}"
+
+metrics = Registry()
+
+async def handle_scrape(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render_prometheus().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def dump_json(path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        write_json(path)
+
+def write_json(path):
+    with open(path, "w") as f:
+        json.dump(metrics.snapshot(), f)
+
+async def start_exporters(config):
+    # Prometheus text on metrics.port and/or a JSON snapshot every metrics.json_interval seconds
+    metrics_config = config.get("metrics", {})
+    tasks = []
+    if metrics_config.get("port"):
+        server = await asyncio.start_server(handle_scrape, metrics_config.get("host", "0.0.0.0"), metrics_config["port"])
+        tasks.append(asyncio.create_task(server.serve_forever()))
+        logger.info(f"Serving metrics on port {metrics_config['port']}")
+    if metrics_config.get("json_path"):
+        tasks.append(asyncio.create_task(dump_json(metrics_config["json_path"], metrics_config.get("json_interval", 60))))
+    return tasks
@@ -0,0 +1,124 @@
+import time
+import asyncio
+import logging
+from collections import namedtuple
+from metrics import metrics
+
+logger = logging.getLogger()
+
+DONE = object()
+
+Stage = namedtuple("Stage", "name handler concurrency batch_size linger")
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+class Pipeline:
+    # Chain of stages joined by bounded queues; each handler returns a list of
+    # items for the next stage, so a stage can drop, pass on or fan out items
+
+    def __init__(self, maxsize=250):
+        self.maxsize = maxsize
+        self.stages = []
+        self.queues = []
+        self.stats = dict()
+
+    def stage(self, name, handler, concurrency=1, batch_size=1, linger=0.05):
+        self.stages.append(Stage(name, handler, concurrency, batch_size, linger))
+        self.stats[name] = {"in": 0, "out": 0, "errors": 0, "busy": 0.0}
+        return self
+
+    async def run(self, source, start=None):
+        # start names the first stage to feed, for items already past the earlier ones
+        stages = self.stages
+        if start is not None:
+            stages = stages[[stage.name for stage in stages].index(start):]
+        self.queues = [asyncio.Queue(self.maxsize) for _ in stages]
+        results = []
+
+        async def feed():
+            async for item in source:
+                await self.queues[0].put(item)
+            for _ in range(stages[0].concurrency):
+                await self.queues[0].put(DONE)
+
+        async def run_stage(index, stage):
+            outbox = self.queues[index + 1] if index + 1 < len(stages) else None
+            await asyncio.gather(*(self.work(stage, self.queues[index], outbox, results) for _ in range(stage.concurrency)))
+            if outbox is not None:
+                for _ in range(stages[index + 1].concurrency):
+                    await outbox.put(DONE)
+
+        tasks = [asyncio.ensure_future(feed())]
+        tasks += [asyncio.ensure_future(run_stage(index, stage)) for index, stage in enumerate(stages)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # A failed source never sends DONE, so the stage workers would wait on their inboxes forever
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return results
+
+    async def next_batch(self, stage, inbox):
+        item = await inbox.get()
+        if item is DONE or stage.batch_size == 1:
+            return [item]
+
+        # Wait briefly for a fuller batch so bulk stages don't run one item at a time
+        batch = [item]
+        deadline = time.monotonic() + stage.linger
+        while len(batch) < stage.batch_size:
+            try:
+                item = inbox.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(inbox.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(item)
+            if item is DONE:
+                break
+        return batch
+
+    async def work(self, stage, inbox, outbox, results):
+        stats = self.stats[stage.name]
+        while True:
+            batch = await self.next_batch(stage, inbox)
+            metrics.set("pipeline_queue_depth", inbox.qsize(), stage=stage.name)
+            done = batch[-1] is DONE
+            if done:
+                batch.pop()
+
+            if batch:
+                stats["in"] += len(batch)
+                start = time.perf_counter()
+                try:
+                    outputs = await stage.handler(batch if stage.batch_size > 1 else batch[0])
+                except Exception:
+                    logger.exception(f"Pipeline stage {stage.name} failed on {len(batch)} item(s)")
+                    stats["errors"] += 1
+                    metrics.inc("pipeline_errors_total", stage=stage.name)
+                    outputs = []
+                elapsed = time.perf_counter() - start
+                stats["busy"] += elapsed
+                stats["out"] += len(outputs)
+                metrics.observe("pipeline_stage_seconds", elapsed, stage=stage.name)
+                metrics.inc("pipeline_items_total", len(batch), stage=stage.name, direction="in")
+                metrics.inc("pipeline_items_total", len(outputs), stage=stage.name, direction="out")
+                for output in outputs:
+                    if outbox is not None:
+                        await outbox.put(output)
+                    else:
+                        results.append(output)
+
+            if done:
+                return
+
+    def queue_depths(self):
+        return {stage.name: queue.qsize() for stage, queue in zip(self.stages[-len(self.queues):], self.queues)}
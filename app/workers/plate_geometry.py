@@ -0,0 +1,65 @@
+import json
+import string
+
+DEFAULT_ROWS = 8
+
+class PlateGeometry:
+    # Every well/drop label of one plate type mapped to its location, which is
+    # a linear sequence left to right across the plate starting at 1
+
+    def __init__(self, name, well_per_row, drops_per_well, rows=DEFAULT_ROWS):
+        for key, value in (("well_per_row", well_per_row), ("drops_per_well", drops_per_well), ("rows", rows)):
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(f"Plate type {name}: {key} must be a positive integer, got {value!r}")
+        if rows > len(string.ascii_uppercase):
+            raise ValueError(f"Plate type {name}: at most {len(string.ascii_uppercase)} rows supported, got {rows}")
+
+        self.name = name
+        self.well_per_row = well_per_row
+        self.drops_per_well = drops_per_well
+        self.rows = rows
+        self.locations = dict()
+        for row in range(rows):
+            letter = string.ascii_uppercase[row]
+            for col in range(well_per_row):
+                for drop in range(drops_per_well):
+                    location = (well_per_row * row * drops_per_well) + (col * drops_per_well) + drop + 1
+                    # Formulatrix writes A1.1, but accept zero padded columns as the old parser did
+                    self.locations[f"{letter}{col + 1}.{drop + 1}"] = location
+                    self.locations[f"{letter}{col + 1:02d}.{drop + 1}"] = location
+
+    def location(self, label):
+        return self.locations.get(label)
+
+class PlateIndex:
+    # All configured plate types, compiled once and shared by every worker with the same "types".
+    # These should be in the database, currently in json format embedded in this collection:
+    # http://ispyb.diamond.ac.uk/beta/client/js/modules/shipment/collections/platetypes.js
+
+    def __init__(self, types):
+        self.plates = {
+            name: PlateGeometry(name, geometry.get("well_per_row"), geometry.get("drops_per_well"), geometry.get("rows", DEFAULT_ROWS))
+            for name, geometry in types.items()
+        }
+        self.labels = frozenset(label for plate in self.plates.values() for label in plate.locations)
+
+    @classmethod
+    def from_config(cls, config):
+        types = config.get("types", {})
+        key = json.dumps(types, sort_keys=True)
+        if key not in plate_indexes:
+            plate_indexes[key] = cls(types)
+        return plate_indexes[key]
+
+    def known_drop(self, label):
+        # Valid on at least one plate type; checked before the container is known
+        return label in self.labels
+
+    def known_type(self, platetype):
+        return platetype in self.plates
+
+    def location(self, platetype, label):
+        plate = self.plates.get(platetype)
+        return plate.location(label) if plate is not None else None
+
+plate_indexes = dict()
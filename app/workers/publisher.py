@@ -0,0 +1,238 @@
+import json
+import time
+import uuid
+import queue
+import asyncio
+import logging
+import threading
+from collections import deque
+from functools import partial
+from types import SimpleNamespace
+from metrics import metrics
+
+logger = logging.getLogger()
+
+class MemoryChannel:
+    # Stand-in for a pika BlockingChannel, for benchmarks and tests without a broker
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue):
+        self.broker.setdefault(queue, [])
+        return SimpleNamespace(method=SimpleNamespace(queue=queue))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker[routing_key].append((body, properties))
+
+class MemoryConnection:
+
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else dict()
+        self.is_open = True
+
+    def channel(self):
+        return MemoryChannel(self.broker)
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+class JobPublisher:
+    # Publishes from a dedicated thread over one long-lived confirming channel.
+    # The event loop only enqueues into a bounded buffer; undelivered messages
+    # are retried with backoff across reconnects rather than dropped
+
+    def __init__(self, connect, queue_name="jobs", reply_queue="res", max_buffer=10000,
+                 batch_size=100, flush_interval=0.05, retry_delay=1, max_retry_delay=60):
+        self.connect = connect
+        self.queue_name = queue_name
+        self.reply_queue = reply_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.buffer = queue.Queue(max_buffer)
+        self.pending = deque()
+        self.stopping = threading.Event()
+        self.abandoned = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.published = 0
+        self.retries = 0
+        self.batches = 0
+        self.confirm_latency_total = 0.0
+        self.confirm_latency_max = 0.0
+        self.started_at = None
+        metrics.gauge("publish_buffer_depth", self.buffer.qsize)
+        metrics.gauge("publish_outstanding", lambda: self.outstanding)
+
+    @classmethod
+    def from_config(cls, config):
+        rabbitmq = config.get("rabbitmq", {})
+        if rabbitmq.get("host") == "memory":
+            connect = MemoryConnection
+        else:
+            # Imported here and in run(), so a run with nothing to publish never loads pika
+            import pika
+            parameters = pika.ConnectionParameters(
+                rabbitmq.get("host", "rabbitmq"),
+                rabbitmq.get("port", 5672),
+                rabbitmq.get("vhost", "/"),
+                pika.PlainCredentials(rabbitmq.get("username", "guest"), rabbitmq.get("password", "guest")),
+                heartbeat=rabbitmq.get("heartbeat", 60),
+            )
+            connect = partial(pika.BlockingConnection, parameters)
+        return cls(
+            connect,
+            queue_name=rabbitmq.get("queue", "jobs"),
+            reply_queue=rabbitmq.get("reply_queue", "res"),
+            max_buffer=rabbitmq.get("max_buffer", 10000),
+            batch_size=rabbitmq.get("batch_size", 100),
+            retry_delay=rabbitmq.get("retry_delay", 1),
+            max_retry_delay=rabbitmq.get("max_retry_delay", 60),
+        )
+
+    def start(self):
+        if self.thread is not None and not self.thread.is_alive() and not self.stopping.is_set():
+            # Jobs it had taken are still in self.pending, so a new thread carries on with them
+            logger.error("Publisher thread died, restarting it")
+            self.thread = None
+        if self.thread is None:
+            self.started_at = time.monotonic()
+            self.thread = threading.Thread(target=self.run, name="job-publisher", daemon=True)
+            self.thread.start()
+
+    async def publish(self, payload, message_id=None):
+        self.start()
+        message = (json.dumps(payload), message_id or str(uuid.uuid4()), time.monotonic())
+        with self.lock:
+            self.outstanding += 1
+        # Bounded buffer: wait for room rather than block the loop or grow without limit
+        while True:
+            try:
+                self.buffer.put_nowait(message)
+                return
+            except queue.Full:
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout else None
+        while self.outstanding:
+            if deadline and time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(self.flush_interval)
+        return True
+
+    def close(self, timeout=30):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.abandoned.set()
+            self.thread.join()
+        if self.outstanding:
+            logger.error(f"Publisher closed with {self.outstanding} undelivered job(s)")
+        self.thread = None
+
+    def open_channel(self):
+        connection = self.connect()
+        channel = connection.channel()
+        channel.confirm_delivery()
+        channel.queue_declare(queue=self.queue_name)
+        channel.queue_declare(queue=self.reply_queue)
+        return connection, channel
+
+    def fill_pending(self, connection):
+        if not self.pending:
+            try:
+                self.pending.append(self.buffer.get(timeout=self.flush_interval))
+            except queue.Empty:
+                if connection is not None:
+                    connection.process_data_events(0)
+                return
+        while len(self.pending) < self.batch_size:
+            try:
+                self.pending.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+
+    def run(self):
+        import pika
+        import pika.exceptions
+        connection = channel = None
+        delay = self.retry_delay
+        while not self.abandoned.is_set():
+            if self.stopping.is_set() and not self.pending and self.buffer.empty():
+                break
+            try:
+                self.fill_pending(connection)
+                if not self.pending:
+                    continue
+                if channel is None:
+                    connection, channel = self.open_channel()
+                while self.pending:
+                    body, message_id, enqueued = self.pending[0]
+                    # Returns once the broker has confirmed, raises on nack
+                    channel.basic_publish(
+                        exchange="",
+                        routing_key=self.queue_name,
+                        properties=pika.BasicProperties(
+                            reply_to=self.reply_queue,
+                            message_id=message_id,
+                        ),
+                        body=body
+                    )
+                    self.pending.popleft()
+                    self.record_confirm(time.monotonic() - enqueued)
+                self.batches += 1
+                connection.process_data_events(0)
+                delay = self.retry_delay
+            except Exception as e:
+                # Anything escaping would end the thread and strand every outstanding job
+                self.retries += 1
+                metrics.inc("publish_retries_total")
+                if isinstance(e, (pika.exceptions.AMQPError, OSError)):
+                    logger.warning(f"Publish failed ({e!r}), retrying {len(self.pending)} job(s) in {delay}s")
+                else:
+                    logger.exception(f"Unexpected publisher error, retrying {len(self.pending)} job(s) in {delay}s")
+                try:
+                    if connection is not None and connection.is_open:
+                        connection.close()
+                except Exception:
+                    pass
+                connection = channel = None
+                self.abandoned.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+        if connection is not None and connection.is_open:
+            connection.close()
+
+    def record_confirm(self, latency):
+        with self.lock:
+            self.outstanding -= 1
+            self.published += 1
+            self.confirm_latency_total += latency
+            self.confirm_latency_max = max(self.confirm_latency_max, latency)
+        metrics.inc("published_total")
+        metrics.observe("publish_confirm_seconds", latency)
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            "published": self.published,
+            "outstanding": self.outstanding,
+            "buffered": self.buffer.qsize(),
+            "batches": self.batches,
+            "retries": self.retries,
+            "throughput": self.published / elapsed if elapsed else 0.0,
+            "confirm_latency_mean": self.confirm_latency_total / self.published if self.published else 0.0,
+            "confirm_latency_max": self.confirm_latency_max,
+        }
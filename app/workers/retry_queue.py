@@ -0,0 +1,122 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from collections import namedtuple
+from metrics import metrics
+
+logger = logging.getLogger()
+
+RetryEntry = namedtuple("RetryEntry", "due attempts reason cache_key")
+
+class RetryQueue:
+    # Parked EF images (no container or sample yet) waiting to be resolved
+    # again, ordered by due time in a heap. Each miss doubles the delay up to
+    # max_delay; entries superseded by a reschedule are skipped when popped
+
+    def __init__(self, base_delay=60, max_delay=3600, factor=2, jitter=0.1, max_attempts=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.heap = []
+        self.entries = dict()
+        self.sequence = itertools.count()
+        self.scheduled = asyncio.Event()
+        self.stopped = False
+        self.given_up = 0
+        metrics.gauge("retry_queue_depth", lambda: len(self.entries))
+
+    @classmethod
+    def from_config(cls, config):
+        retry = config.get("retry", {})
+        return cls(
+            base_delay=retry.get("base_delay", 60),
+            max_delay=retry.get("max_delay", 3600),
+            factor=retry.get("factor", 2),
+            jitter=retry.get("jitter", 0.1),
+            max_attempts=retry.get("max_attempts"),
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def delay(self, attempts):
+        delay = min(self.max_delay, self.base_delay * self.factor ** (attempts - 1))
+        # Spread out files parked together so their re-checks don't all land at once
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def schedule(self, path, reason, cache_key=None, previous=None, attempts=None):
+        # previous is the path the file had before this miss moved it, e.g. from nosession to nosample
+        entry = self.entries.pop(previous, None) if previous else None
+        entry = self.entries.pop(path, entry)
+        if attempts is None:
+            attempts = (entry.attempts if entry else 0) + 1
+        if self.max_attempts and attempts > self.max_attempts:
+            self.given_up += 1
+            metrics.inc("retry_given_up_total", reason=reason)
+            logger.error(f"Giving up on {path} after {attempts - 1} attempt(s), left in {reason}")
+            return
+        due = time.monotonic() + self.delay(attempts)
+        self.entries[path] = RetryEntry(due, attempts, reason, cache_key)
+        heapq.heappush(self.heap, (due, next(self.sequence), path))
+        metrics.inc("retry_scheduled_total", reason=reason)
+        self.scheduled.set()
+
+    def discard(self, path):
+        self.entries.pop(path, None)
+
+    def next_due(self):
+        while self.heap:
+            due, _, path = self.heap[0]
+            entry = self.entries.get(path)
+            if entry is not None and entry.due == due:
+                return due
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, limit):
+        now = time.monotonic()
+        due = []
+        while len(due) < limit:
+            next_due = self.next_due()
+            if next_due is None or next_due > now:
+                break
+            _, _, path = heapq.heappop(self.heap)
+            # Left in entries until the retry succeeds or reschedules it, so attempts carry over
+            due.append((path, self.entries[path]))
+        return due
+
+    def settle(self, batch):
+        # Anything the retry neither published nor parked again counts as another miss
+        for path, entry in batch:
+            if self.entries.get(path) is entry:
+                self.schedule(path, entry.reason, entry.cache_key)
+
+    def stop(self):
+        self.stopped = True
+        self.scheduled.set()
+
+    async def batches(self, max_batch):
+        # Sleeps until the earliest entry falls due, or something earlier is scheduled
+        while not self.stopped:
+            self.scheduled.clear()
+            batch = self.pop_due(max_batch)
+            if batch:
+                yield batch
+                continue
+            next_due = self.next_due()
+            timeout = None if next_due is None else max(0, next_due - time.monotonic())
+            try:
+                await asyncio.wait_for(self.scheduled.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self):
+        reasons = dict()
+        for entry in self.entries.values():
+            reasons[entry.reason] = reasons.get(entry.reason, 0) + 1
+        return {"waiting": len(self.entries), "by_reason": reasons, "given_up": self.given_up}
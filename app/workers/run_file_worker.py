@@ -1,34 +1,102 @@
-import glob
-from formulatrix_uploader import FormulatrixUploader
 import asyncio
 import re
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
-import ispyb.sqlalchemy
-import time
 import json
+import signal
+import argparse
 
-async def main(engine, session):
-    # Create an instance of the FormulatrixUploader
+def load_configs():
     config_file_ef = "../../config/config_ef.json"
     config_file_z = "../../config/config_z.json"
     with open(config_file_ef, 'r') as j:
         config_ef = json.loads(j.read())
     with open(config_file_z, 'r') as j:
         config_z = json.loads(j.read())
+    return config_ef, config_z
+
+# The uploader stack is imported inside serve() and main(): image pool workers
+# started with spawn or forkserver import this module as __mp_main__, and
+# should only pay for image_transforms
+
+async def serve(engine, session):
+    from formulatrix_uploader import FormulatrixUploader
+    from metadata_cache import MetadataCache
+    from image_pool import ImagePool
+    from work_journal import WorkJournal
+    from metrics import start_exporters
+    from database import Database
+
+    config_ef, config_z = load_configs()
+    cache = MetadataCache.from_config(config_ef)
+    uploader = FormulatrixUploader(cache, ImagePool.from_config(config_ef), journal=WorkJournal.from_config(config_ef))
+    # One limiter in front of the connection pool for both workers
+    db = Database.from_config(session, config_ef)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, uploader.stop)
+
+    exporters = await start_exporters(config_ef)
+    await uploader.pool.warm()
+    try:
+        await uploader.serve([config_ef, config_z], db)
+    finally:
+        for exporter in exporters:
+            exporter.cancel()
+        uploader.close()
+
+async def main(engine, session):
+    from formulatrix_uploader import FormulatrixUploader
+    from metadata_cache import MetadataCache
+    from image_pool import ImagePool
+    from work_journal import WorkJournal
+    from metrics import write_json
+    from database import Database
+    from shared_worker_functions import stat_ready
+
+    # Create an instance of the FormulatrixUploader
+    config_ef, config_z = load_configs()
     
-    date_dirs = [glob.glob(f'{config_z["holding_dir"]}/*')]
-    ef_files = [glob.glob(f'{config_ef["holding_dir"]}/*.*')]
-    start = time.time()
-    worker = FormulatrixUploader()
-    result_ef = await worker.process_job(ef_files,config_ef,session)
-    worker = FormulatrixUploader()
-    result_z = await worker.process_job(date_dirs,config_z,session)
-    elapsed = time.time() - start
-    print(f"{result_ef} \n {result_z} \n Execution Time: {elapsed}")
+    # Shared by the EF and Z workers so repeat plates skip the database
+    cache = MetadataCache.from_config(config_ef)
+    worker = FormulatrixUploader(cache, ImagePool.from_config(config_ef), config_ef.get("max_concurrent_jobs", 4), WorkJournal.from_config(config_ef))
+    db = Database.from_config(session, config_ef)
+    # Pool workers start up while the holding dirs are scanned
+    warming = worker.pool.warm()
+    z_index, date_dirs = worker.scan(config_z)
+    ef_index, ef_files = worker.scan(config_ef)
+    scanned = set(ef_files)
+    ef_files += [f for f in worker.unfinished(config_ef) if f not in scanned]
+    await warming
+    try:
+        result = await worker.run_jobs([(ef_files, config_ef), (date_dirs, config_z)], db)
+    finally:
+        # Images that were still settling at scan time are looked at again on the next run
+        ef_index.mark_emitted([f for f in ef_files if stat_ready(ef_index.stat(f))])
+        z_index.mark_emitted(date_dirs)
+        worker.journal.prune(ef_index.handed_off)
+        worker.close()
+        ef_index.save()
+        z_index.save()
+    for job in result["jobs"]:
+        print(f"{job['task']}: {job['items']} item(s) in {job['units']} unit(s), {job['errors']} error(s), {job['elapsed']:.2f}s")
+        for unit in job["results"]:
+            print(f"  {unit['result'] or unit['error']} ({unit['elapsed']:.2f}s)")
+    print(f"Execution Time: {result['elapsed']}")
+    print(f"Database limiter: {db.stats()}")
+    if config_ef.get("metrics", {}).get("json_path"):
+        write_json(config_ef["metrics"]["json_path"])
     #await asyncio.sleep(10)
 
 if __name__ == "__main__":
+    from database import engine_options
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.orm import sessionmaker
+    import ispyb.sqlalchemy
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", help="Watch the holding directories and upload continuously")
+    args = parser.parse_args()
+
     credentials_path = "../../config/dbconf.json"
     with open(credentials_path, 'r') as j:
         credentials = json.loads(j.read())
@@ -36,7 +104,7 @@ if __name__ == "__main__":
     # Generate Db URL, but use asyncmy driver
     url = re.sub(r'\+(.*?)\:',r'+asyncmy:' , ispyb.sqlalchemy.url(credentials))
     try:
-        engine = create_async_engine(url, pool_size=1, max_overflow=1)
+        engine = create_async_engine(url, **engine_options(load_configs()[0]))
         session = sessionmaker(
             bind=engine,
             class_=AsyncSession,
@@ -45,6 +113,6 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"Failed to establish ISPyB connection: {e}")
     try:
-        asyncio.run(main(engine, session))
+        asyncio.run(serve(engine, session) if args.daemon else main(engine, session))
     except KeyboardInterrupt:
         print("Exiting uploader...")
\ No newline at end of file
@@ -1,27 +1,54 @@
 import os
-import subprocess
-import time
-import shutil
-from PIL import Image
 import asyncio
-from sqlalchemy import text
+from sqlalchemy import text, bindparam
 import logging
 import sys
 import logging.handlers
-from collections import namedtuple
-import pika
-import json
 import uuid
-
+from functools import partial
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+# The image pool's half lives in image_transforms, which pool workers import on their own
+from image_transforms import *
+from dir_index import cached_stat
+from metrics import metrics
 
 logger = logging.getLogger()
 
-async def get_visit_dir(container, config):
+QUERY_CHUNK_SIZE = 500
+IO_WORKERS = 32
+
+# Blocking filesystem calls run here rather than on the event loop, which
+# otherwise stalls every in-flight DB query while NFS/GPFS answers a stat
+io_executor = None
+
+def run_io(fn, *args, **kwargs):
+    global io_executor
+    if io_executor is None:
+        io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="fs-io")
+    return asyncio.get_running_loop().run_in_executor(io_executor, partial(fn, *args, **kwargs))
+
+def fs_memo():
+    # In-flight or finished directory work for one batch. Per batch rather than
+    # global, as several EF and Z batches run at once and a new one must not
+    # wipe the others' memos
+    return SimpleNamespace(created_dirs=dict(), visit_dirs=dict())
+
+def find_visit_dir(old_root, new_root):
+    return old_root if os.path.exists(old_root) else new_root if os.path.exists(new_root) else None
+
+async def get_visit_dir(container, config, memo):
     visit = container["visit"]
     proposal = visit[: visit.index("-")]
     new_root = f"{config['upload_dir']}/{proposal}/{visit}"
     old_root = f"{config['upload_dir']}/{container['year']}/{visit}"
-    return old_root if os.path.exists(old_root) else new_root if os.path.exists(new_root) else None
+    key = (old_root, new_root)
+    if key not in memo.visit_dirs:
+        metrics.inc("visit_dir_lookups_total", result="resolved")
+        memo.visit_dirs[key] = asyncio.ensure_future(run_io(find_visit_dir, old_root, new_root))
+    else:
+        metrics.inc("visit_dir_lookups_total", result="memo")
+    return await memo.visit_dirs[key]
 
 def move_unhandled(files_target):
     image, xml, target = files_target[0], files_target[1], files_target[2]
@@ -29,36 +56,67 @@ def move_unhandled(files_target):
     for file in [image,xml]:
         os.rename(file, f"{target}/{os.path.basename(file)}")
 
-def transpose_and_save(f, new_f):
-    im = Image.open(f)
-    im_flipped = im.transpose(Image.FLIP_TOP_BOTTOM)
-    im_flipped.save(new_f)
-    return im_flipped
+async def file_ready_async(f):
+    st = cached_stat(f)
+    if st is not None and stat_ready(st):
+        return True
+    return await run_io(file_ready, f)
 
-def file_ready(f): return True if time.time() - os.stat(f).st_mtime > 10 and os.stat(f).st_size > 0 else False
+def pair_ready(f):
+    # An EF image is only ready once both the .jpg and its .xml are; a partner
+    # that hasn't landed yet means not ready, only f itself missing raises
+    base, ext = os.path.splitext(f)
+    if not file_ready(f):
+        return False
+    try:
+        return file_ready(f"{base}.xml" if ext == ".jpg" else f"{base}.jpg")
+    except FileNotFoundError:
+        return False
+
+def list_files(path):
+    # Same entries as glob(f"{path}/*"), from a single scandir pass
+    with os.scandir(path) as entries:
+        return [entry.path for entry in entries if not entry.name.startswith(".")]
+
+def dir_ready(d):
+    files = [os.path.join(root, name) for root, _, names in os.walk(d) for name in names]
+    return bool(files) and all(file_ready(f) for f in files)
 
 async def rmdir(src_dir):
     try:
-        os.rmdir(src_dir)
+        await run_io(os.rmdir, src_dir)
         logger.info(f"Trying to rm {src_dir}")
     except OSError:
         logger.error(f"Could not rm {src_dir}, as it is not empty")
         pass
 
-async def make_dirs(path, config):
-    if not os.path.exists(path):
+async def make_dirs(path, config, memo):
+    # Concurrent callers for the same path share one task, so each directory
+    # is stat'ed, created and ACL'd once per batch rather than once per image
+    if path not in memo.created_dirs:
+        metrics.inc("make_dirs_total", result="checked")
+        memo.created_dirs[path] = asyncio.ensure_future(create_dirs(path, config))
+    else:
+        metrics.inc("make_dirs_total", result="memo")
+    return await memo.created_dirs[path]
+
+async def create_dirs(path, config):
+    with metrics.time("make_dirs_seconds"):
+        return await create_dirs_untimed(path, config)
+
+async def create_dirs_untimed(path, config):
+    if not await run_io(os.path.exists, path):
         try:
-            os.makedirs(path)
+            await run_io(os.makedirs, path, exist_ok=True)
             if config.get("web_user"):
-                subprocess.call(
-                    [
-                        "/usr/bin/setfacl",
-                        "-R",
-                        "-m",
-                        "u:" + config["web_user"] + ":rwx",
-                        path,
-                    ]
+                process = await asyncio.create_subprocess_exec(
+                    "/usr/bin/setfacl",
+                    "-R",
+                    "-m",
+                    "u:" + config["web_user"] + ":rwx",
+                    path,
                 )
+                await process.wait()
         except NotADirectoryError:
             return False
 
@@ -74,75 +132,87 @@ async def make_dirs(path, config):
 
     return True
 
-def move_dir(f, target_dir):
-    if file_ready(f):
-        new_f = os.path.join(target_dir, os.path.basename(f))
-        try:
-            old_file, ext = os.path.splitext(f)
-            if ext == ".tif":
-                transpose_and_save(f,new_f)
-            else:
-                shutil.copyfile(f, new_f)
-            try:
-                os.unlink(f)
-            except IOError:
-                logger.error(f"Error deleting image file {f})")
-                pass
-        except IOError:
-            logger.error(
-                f"Error flipping/copying image file {f} to {new_f}"
-            )
-            pass
-    else:
-        logger.info(f"Not moving file {f} yet")
-        pass
-    return
+CONTAINER_FOR_BARCODE = text('SELECT concat(p.proposalCode, p.proposalNumber, "-", bs.visit_number) "visit", date_format(c.blTimeStamp, "%Y") "year" FROM Container c LEFT OUTER JOIN BLSession bs ON bs.sessionId = c.sessionId LEFT OUTER JOIN Proposal p ON p.proposalId = bs.proposalId WHERE c.barcode=:barcode LIMIT 1;')
+CONTAINERS_FOR_INSPECTIONS = text('SELECT ci.containerInspectionId "inspectionId", c.containerType, c.containerId, c.sessionId, concat(p.proposalCode, p.proposalNumber, "-", bs.visit_number) "visit", date_format(c.blTimeStamp, "%Y") as year FROM Container c INNER JOIN ContainerInspection ci ON ci.containerId = c.containerId INNER JOIN Dewar d ON d.dewarId = c.dewarId INNER JOIN Shipping s ON s.shippingId = d.shippingId INNER JOIN Proposal p ON p.proposalId = s.proposalId LEFT OUTER JOIN BLSession bs ON bs.sessionId = c.sessionId WHERE ci.containerInspectionId IN :ids;').bindparams(bindparam("ids", expanding=True))
+SAMPLES_FOR_CONTAINERS = text('SELECT containerId, location, blSampleId FROM BLSample WHERE containerId IN :ids ORDER BY blSampleId;').bindparams(bindparam("ids", expanding=True))
 
-def move_file(xml, new_f, inspectionId, location, config):
-    image = xml.replace(".xml",".jpg")
-    try:
-        flip = transpose_and_save(image,new_f)
-        file, ext = os.path.splitext(new_f)
-        
-        try:
-            flip.thumbnail(
-                (config["thumb_width"], config["thumb_height"])
-            )
-            try:
-                #flip.save(f"{file}th{ext}")
-                pass
-            except IOError:
-                print("Error saving file")
-                return xml, None, inspectionId, location
-            try:
-                #os.unlink(image)
-                #os.unlink(xml) ## Currently, nothing goes 
-                return xml, new_f, inspectionId, location
-            except:
-                return xml, None, inspectionId, location
-        except IOError:
-            return xml, None, inspectionId, location
-    except IOError:
-        return xml, None, inspectionId, location
-    
-async def retrieve_container_for_barcode(barcode, session):
-    async with session() as connection:
-        async with connection.begin():
-            result = await connection.execute(text(f'SELECT concat(p.proposalCode, p.proposalNumber, "-", bs.visit_number) "visit", date_format(c.blTimeStamp, "%Y") "year" FROM Container c LEFT OUTER JOIN BLSession bs ON bs.sessionId = c.sessionId LEFT OUTER JOIN Proposal p ON p.proposalId = bs.proposalId WHERE c.barcode="{barcode}" LIMIT 1;'))
-        return result.mappings().all()[0]
-
-async def retrieve_container_for_inspectionId(inspectionId, session, sem):
-    async with sem:
-        async with session() as connection:
-            async with connection.begin():
-                result = await connection.execute(text(f'SELECT c.containerType, c.containerId, c.sessionId, concat(p.proposalCode, p.proposalNumber, "-", bs.visit_number) "visit", date_format(c.blTimeStamp, "%Y") as year FROM Container c INNER JOIN ContainerInspection ci ON ci.containerId = c.containerId INNER JOIN Dewar d ON d.dewarId = c.dewarId INNER JOIN Shipping s ON s.shippingId = d.shippingId INNER JOIN Proposal p ON p.proposalId = s.proposalId LEFT OUTER JOIN BLSession bs ON bs.sessionId = c.sessionId WHERE ci.containerinspectionId = {inspectionId} LIMIT 1;'))
-            return {inspectionId: result.mappings().all()[0]}
-
-async def retrieve_sample_for_container_id_and_location(p_location, p_containerId, session):
-    async with session() as connection:
-        async with connection.begin():
-            result = await connection.execute(text(f'SELECT blSampleId FROM BLSample WHERE containerId="{p_containerId}" AND location="{p_location}" LIMIT 1;'))
-    return result.fetchone()
+async def retrieve_container_for_barcode(barcode, db, connection=None):
+    async with db.connect(connection) as connection:
+        result = await connection.execute(CONTAINER_FOR_BARCODE, {"barcode": barcode}, "container_for_barcode")
+        row = result.mappings().first()
+    return dict(row) if row else None
+
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+async def retrieve_containers_for_inspectionIds(inspectionIds, db, chunk_size=QUERY_CHUNK_SIZE, connection=None):
+    # One IN (...) query per chunk, rather than one query per inspection
+    containers = {inspectionId: None for inspectionId in inspectionIds}
+    async with db.connect(connection) as connection:
+        for chunk in chunked(containers, chunk_size):
+            result = await connection.execute(CONTAINERS_FOR_INSPECTIONS, {"ids": [int(i) for i in chunk]}, "containers_for_inspections")
+            for row in result.mappings().all():
+                inspectionId = str(row["inspectionId"])
+                if containers.get(inspectionId) is None:
+                    containers[inspectionId] = dict(row)
+    return containers
+
+async def retrieve_samples_for_containerIds(containerIds, db, chunk_size=QUERY_CHUNK_SIZE, connection=None):
+    # Maps (containerId, location) to blSampleId for every sample in the given containers
+    samples = dict()
+    async with db.connect(connection) as connection:
+        for chunk in chunked(set(containerIds), chunk_size):
+            result = await connection.execute(SAMPLES_FOR_CONTAINERS, {"ids": chunk}, "samples_for_containers")
+            for row in result.mappings().all():
+                samples.setdefault((row["containerId"], str(row["location"])), row["blSampleId"])
+    return samples
+
+async def cached_container_for_barcode(barcode, db, cache, connection=None):
+    found, container = cache.get("barcode", barcode)
+    if not found:
+        container = await retrieve_container_for_barcode(barcode, db, connection)
+        cache.set("barcode", barcode, container)
+    return container
+
+async def cached_containers_for_inspectionIds(inspectionIds, db, cache, connection=None):
+    containers = dict()
+    missing = []
+    for inspectionId in inspectionIds:
+        found, container = cache.get("inspection", inspectionId)
+        if found:
+            containers[inspectionId] = container
+        else:
+            missing.append(inspectionId)
+
+    if missing:
+        fetched = await retrieve_containers_for_inspectionIds(missing, db, connection=connection)
+        for inspectionId, container in fetched.items():
+            cache.set("inspection", inspectionId, container)
+        containers.update(fetched)
+    return containers
+
+async def cached_samples_for_locations(container_locations, db, cache, connection=None):
+    # container_locations are (containerId, location) pairs, location as str
+    samples = dict()
+    missing = set()
+    for key in container_locations:
+        found, sampleid = cache.get("sample", key)
+        if found:
+            samples[key] = sampleid
+        else:
+            missing.add(key)
+
+    if missing:
+        fetched = await retrieve_samples_for_containerIds({containerId for containerId, _ in missing}, db, connection=connection)
+        for key, sampleid in fetched.items():
+            cache.set("sample", key, sampleid)
+        for key in missing:
+            samples[key] = fetched.get(key)
+            if key not in fetched:
+                cache.set("sample", key, None)
+    return samples
 
 def set_logging(logs):
     levels_dict = {
@@ -180,22 +250,13 @@ def set_logging(logs):
             handler.setLevel(logging.WARNING)
         logger.addHandler(handler)
 
-def publish(job, channel, callback):
-    
-    payload = {
+def job_payload(job):
+    return {
         "plate": f"{job.inspectionId}",
         "well": int(job.location),
         "image_path": f"{job.new_path}"
     }
 
-    delivery = json.dumps(payload)
-
-    channel.basic_publish(
-        exchange="",
-        routing_key="jobs",
-        properties=pika.BasicProperties(
-            reply_to=callback
-        ),
-        body=delivery
-    )
-    print(f"Sent job: {delivery}")
\ No newline at end of file
+def job_message_id(job):
+    # Stable per target image, so consumers can drop re-sent jobs
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, job.new_path))
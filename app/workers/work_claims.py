@@ -0,0 +1,219 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from metrics import metrics
+
+logger = logging.getLogger()
+
+CLAIMS_DIR = ".claims"
+DONE_DIR = "done"
+
+def restore(src, dst):
+    # Move src back to dst, merging into dst when both are directories
+    try:
+        os.rename(src, dst)
+        return
+    except OSError:
+        if not (os.path.isdir(src) and os.path.isdir(dst)):
+            raise
+    for name in os.listdir(src):
+        restore(os.path.join(src, name), os.path.join(dst, name))
+    os.rmdir(src)
+
+class WorkClaims:
+    # Lets several uploader instances share one holding directory. Work is
+    # claimed by renaming it into <holding_dir>/.claims/<instance>/, which is
+    # atomic on one filesystem, so exactly one instance wins each item. Each
+    # instance touches <instance>.lease every heartbeat; the staging dir of an
+    # instance whose lease goes stale is moved back for the others to pick up
+
+    def __init__(self, holding_dir, instance_id=None, lease_timeout=120, heartbeat_interval=30):
+        self.holding_dir = holding_dir
+        self.instance_id = instance_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.claims_dir = os.path.join(holding_dir, CLAIMS_DIR)
+        self.staging_dir = os.path.join(self.claims_dir, self.instance_id)
+        self.lease_path = os.path.join(self.claims_dir, f"{self.instance_id}.lease")
+        self.done_dir = os.path.join(self.claims_dir, DONE_DIR)
+        # Holding-dir paths release() has just put back, so the watcher can tell
+        # our own renames from new work, see returned()
+        self.released = dict()
+
+    @classmethod
+    def from_config(cls, config):
+        # None unless coordination is switched on, so a lone instance works on the holding dir directly
+        coordination = config.get("coordination", {})
+        if not coordination.get("enabled"):
+            return None
+        return cls(
+            config["holding_dir"],
+            coordination.get("instance_id") or os.environ.get("UPLOADER_INSTANCE_ID"),
+            coordination.get("lease_timeout", 120),
+            coordination.get("heartbeat_interval", 30),
+        )
+
+    def start(self):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.renew()
+        # Anything left from a previous life of this instance goes back first
+        self.release([os.path.join(self.staging_dir, name) for name in os.listdir(self.staging_dir)])
+        self.reclaim_dead()
+        logger.info(f"Claiming work in {self.holding_dir} as {self.instance_id}")
+
+    def renew(self):
+        with open(self.lease_path, "a"):
+            pass
+        os.utime(self.lease_path)
+
+    def claim_files(self, paths, group):
+        # Members of a group (an image and its XML) are claimed together; the
+        # first rename decides the owner, so a lost race costs one syscall.
+        # The staging dir is recreated in case another instance took it during a stall
+        os.makedirs(self.staging_dir, exist_ok=True)
+        groups = dict()
+        for path in paths:
+            groups.setdefault(group(path), []).append(path)
+        claimed = []
+        for members in groups.values():
+            for i, path in enumerate(sorted(members)):
+                target = os.path.join(self.staging_dir, os.path.basename(path))
+                try:
+                    os.rename(path, target)
+                except FileNotFoundError:
+                    if i == 0:
+                        metrics.inc("claims_total", result="lost")
+                        break
+                    logger.error(f"{path} vanished after its group was claimed")
+                    continue
+                claimed.append(target)
+            else:
+                metrics.inc("claims_total", result="won")
+        return claimed
+
+    def claim_children(self, dirs):
+        # Z date dirs keep filling up, so the barcode dirs inside them are the unit of work
+        claimed = []
+        os.makedirs(self.staging_dir, exist_ok=True)
+        for date_dir in dirs:
+            target_dir = os.path.join(self.staging_dir, os.path.basename(date_dir))
+            try:
+                names = os.listdir(date_dir)
+            except FileNotFoundError:
+                continue
+            won = 0
+            for name in names:
+                path = os.path.join(date_dir, name)
+                if name.startswith(".") or not os.path.isdir(path):
+                    continue
+                os.makedirs(target_dir, exist_ok=True)
+                try:
+                    os.rename(path, os.path.join(target_dir, name))
+                    won += 1
+                except FileNotFoundError:
+                    metrics.inc("claims_total", result="lost")
+            if won:
+                metrics.inc("claims_total", won, result="won")
+                claimed.append(target_dir)
+            try:
+                os.rmdir(date_dir)
+            except OSError:
+                pass
+        return claimed
+
+    def release(self, claimed):
+        # Whatever is still staged after processing goes back to the holding dir
+        released = 0
+        now = time.time()
+        for target, when in list(self.released.items()):
+            if now - when > self.lease_timeout:
+                self.released.pop(target, None)
+        for path in claimed:
+            if not os.path.exists(path):
+                continue
+            target = os.path.join(self.holding_dir, os.path.relpath(path, self.staging_dir))
+            # Noted before the rename, as the watcher may see the event straight away
+            self.released[target] = now
+            try:
+                restore(path, target)
+                released += 1
+            except OSError as e:
+                self.released.pop(target, None)
+                logger.error(f"Could not return {path} to {self.holding_dir}: {e}")
+        if released:
+            metrics.inc("claims_released_total", released)
+        return released
+
+    def returned(self, path):
+        # True, once, for a path this instance has just released. Unfinished
+        # work is retried through the journal, not as soon as it lands back
+        return self.released.pop(path, None) is not None
+
+    def retire(self, paths):
+        # EF sources are not deleted after upload (see move_file), so finished
+        # ones are parked here rather than going back for another instance to redo
+        os.makedirs(self.done_dir, exist_ok=True)
+        for path in paths:
+            try:
+                os.rename(path, os.path.join(self.done_dir, os.path.basename(path)))
+            except FileNotFoundError:
+                pass
+
+    def reclaim_dead(self):
+        now = time.time()
+        reclaimed = 0
+        for name in os.listdir(self.claims_dir):
+            path = os.path.join(self.claims_dir, name)
+            if name in (self.instance_id, DONE_DIR) or name.endswith(".lease") or not os.path.isdir(path):
+                continue
+            # A half-finished reclaim belongs to whoever started it, and is picked up if they die too
+            owner = name.split(".reclaim-")[-1]
+            if owner != self.instance_id:
+                try:
+                    if now - os.stat(os.path.join(self.claims_dir, f"{owner}.lease")).st_mtime < self.lease_timeout:
+                        continue
+                except FileNotFoundError:
+                    pass
+            if ".reclaim-" in name:
+                taken = path
+            else:
+                # Rename first so only one live instance reclaims a given dead one
+                taken = f"{path}.reclaim-{self.instance_id}"
+                try:
+                    os.rename(path, taken)
+                except OSError:
+                    continue
+            logger.warning(f"Reclaiming work from {name}, whose lease expired")
+            for entry in os.listdir(taken):
+                try:
+                    restore(os.path.join(taken, entry), os.path.join(self.holding_dir, entry))
+                    reclaimed += 1
+                except OSError as e:
+                    logger.error(f"Could not reclaim {entry} from {name}: {e}")
+            try:
+                os.rmdir(taken)
+                os.unlink(os.path.join(self.claims_dir, f"{name.split('.reclaim-')[0]}.lease"))
+            except OSError:
+                pass
+        if reclaimed:
+            metrics.inc("claims_reclaimed_total", reclaimed)
+        return reclaimed
+
+    def close(self):
+        self.release([os.path.join(self.staging_dir, name) for name in os.listdir(self.staging_dir)])
+        try:
+            os.rmdir(self.staging_dir)
+            os.unlink(self.lease_path)
+        except OSError:
+            pass
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await asyncio.to_thread(self.renew)
+                await asyncio.to_thread(self.reclaim_dead)
+            except OSError:
+                logger.exception(f"Heartbeat failed for {self.instance_id}")
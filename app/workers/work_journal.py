@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from work_claims import CLAIMS_DIR
+
+logger = logging.getLogger()
+
+DISCOVERED = 0
+RESOLVED = 1
+TRANSFORMED = 2
+PUBLISHED = 3
+CLEANED = 4
+
+STATE_NAMES = ("discovered", "resolved", "transformed", "published", "cleaned")
+
+def journal_key(path):
+    # Rows are keyed on where a file sits in the holding dir, not on the
+    # .claims/<instance>/ dir it was staged in while this instance worked on it,
+    # so work released or reclaimed by another instance is still recognised
+    parts = path.split(os.sep)
+    if CLAIMS_DIR in parts[:-2]:
+        i = parts.index(CLAIMS_DIR)
+        return os.sep.join(parts[:i] + parts[i + 2:])
+    return path
+
+class WorkJournal:
+    # Per-file progress in SQLite (WAL), so a restart resumes unfinished work
+    # instead of re-parsing, re-querying, re-flipping and re-publishing everything
+
+    def __init__(self, path=":memory:", flush_size=500, retention=7 * 24 * 3600, prune_batch=500):
+        self.path = path
+        self.flush_size = flush_size
+        self.retention = retention
+        self.prune_batch = prune_batch
+        # Where the last prune's existence checks stopped, as (updated, path)
+        self.swept = None
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, task TEXT, state INTEGER, data TEXT, updated REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_task_state ON files (task, state)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_updated ON files (updated, path)")
+        self.buffer = dict()
+        # Only the cheap part at startup; the existence checks run later, a batch at a time
+        self.prune(limit=0)
+
+    @classmethod
+    def from_config(cls, config):
+        journal = config.get("journal", {})
+        return cls(
+            journal.get("path", ":memory:"),
+            flush_size=journal.get("flush_size", 500),
+            retention=journal.get("retention", 7 * 24 * 3600),
+            prune_batch=journal.get("prune_batch", 500),
+        )
+
+    def record(self, path, task, state, data=None):
+        path = journal_key(path)
+        previous = self.buffer.get(path)
+        if previous and previous[2] > state:
+            return
+        if previous and data is None:
+            data = previous[3]
+        self.buffer[path] = (path, task, state, data, time.time())
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def record_many(self, paths, task, state):
+        for path in paths:
+            self.record(path, task, state)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        # States only move forward, and a later write without data keeps the earlier data
+        self.db.execute("BEGIN")
+        self.db.executemany(
+            "INSERT INTO files (path, task, state, data, updated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET "
+            "state = MAX(files.state, excluded.state), "
+            "data = COALESCE(excluded.data, files.data), "
+            "updated = excluded.updated",
+            [(path, task, state, json.dumps(data) if data is not None else None, updated)
+             for path, task, state, data, updated in self.buffer.values()],
+        )
+        self.db.execute("COMMIT")
+        self.buffer.clear()
+
+    def states(self, paths):
+        # Keyed on the paths passed in, staged or not
+        self.flush()
+        states = dict()
+        keys = dict()
+        for path in paths:
+            keys.setdefault(journal_key(path), []).append(path)
+        chunks = list(keys)
+        for i in range(0, len(chunks), 500):
+            chunk = chunks[i:i + 500]
+            rows = self.db.execute(
+                f"SELECT path, state, data FROM files WHERE path IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, state, data in rows:
+                for path in keys[key]:
+                    states[path] = (state, json.loads(data) if data else None)
+        return states
+
+    def unfinished(self, task, below=PUBLISHED, before=None):
+        # before: only rows last updated (or touched) before then
+        self.flush()
+        if before is None:
+            rows = self.db.execute("SELECT path, state, data FROM files WHERE task = ? AND state < ?", (task, below))
+        else:
+            rows = self.db.execute(
+                "SELECT path, state, data FROM files WHERE task = ? AND state < ? AND updated < ?", (task, below, before)
+            )
+        return {path: (state, json.loads(data) if data else None) for path, state, data in rows}
+
+    def touch(self, paths):
+        # Marks rows as just retried without moving their state
+        self.flush()
+        now = time.time()
+        self.db.executemany("UPDATE files SET updated = ? WHERE path = ?", [(now, journal_key(path)) for path in paths])
+
+    def counts(self):
+        self.flush()
+        rows = self.db.execute("SELECT task, state, COUNT(*) FROM files GROUP BY task, state")
+        return {f"{task}.{STATE_NAMES[state]}": count for task, state, count in rows}
+
+    def prune(self, settled=None, limit=None):
+        # Drops rows older than the retention period that can't lead to a redo:
+        # cleaned ones (the source was deleted), published ones settled(path)
+        # says a scan won't offer again (EF sources stay in the holding dir, see
+        # DirectoryIndex.handed_off), and ones whose source has gone. The last
+        # costs a stat per row, so each call checks at most limit rows, oldest
+        # first, carrying on from where the previous call stopped
+        self.flush()
+        cutoff = time.time() - self.retention
+        limit = self.prune_batch if limit is None else limit
+        self.db.execute("DELETE FROM files WHERE updated < ? AND state = ?", (cutoff, CLEANED))
+        if settled is not None:
+            rows = self.db.execute("SELECT path FROM files WHERE updated < ? AND state = ?", (cutoff, PUBLISHED)).fetchall()
+            self.db.executemany("DELETE FROM files WHERE path = ?", [(path,) for (path,) in rows if settled(path)])
+        if not limit:
+            return
+        if self.swept is None:
+            rows = self.db.execute(
+                "SELECT updated, path FROM files WHERE updated < ? ORDER BY updated, path LIMIT ?", (cutoff, limit)
+            ).fetchall()
+        else:
+            rows = self.db.execute(
+                "SELECT updated, path FROM files WHERE updated < ? AND (updated, path) > (?, ?) ORDER BY updated, path LIMIT ?",
+                (cutoff, *self.swept, limit),
+            ).fetchall()
+        # Back to the oldest once a pass reaches the end
+        self.swept = rows[-1] if len(rows) == limit else None
+        self.db.executemany("DELETE FROM files WHERE path = ?", [(path,) for _, path in rows if not os.path.lexists(path)])
+
+    def close(self):
+        self.flush()
+        self.db.close()
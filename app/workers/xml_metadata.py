@@ -0,0 +1,96 @@
+import os
+import re
+import asyncio
+import itertools
+import xml.etree.ElementTree as ET
+from image_transforms import stage
+from metrics import metrics
+
+SIZE_TAGS = ("SizeInMicrons", "SizeInPixels")
+DIMENSION_TAGS = ("Width", "Height")
+FIELDS_WANTED = 6
+
+class XmlRecord:
+    # Only the fields the uploader uses, so the parsed tree can be thrown away straight away
+    __slots__ = ("xml", "mtime", "inspectionId", "drop", "microns", "pixels")
+
+    def __init__(self, xml, mtime=None, inspectionId=None, drop=None, microns=None, pixels=None):
+        self.xml = xml
+        self.mtime = mtime
+        self.inspectionId = inspectionId
+        self.drop = drop
+        self.microns = microns
+        self.pixels = pixels
+
+    def __repr__(self):
+        return f"XmlRecord({self.xml!r}, inspectionId={self.inspectionId!r}, drop={self.drop!r})"
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def parse_xml(xml):
+    values = dict()
+    stack = []
+    try:
+        with open(xml, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            for event, elem in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    stack.append(local_name(elem.tag))
+                    continue
+
+                name = stack.pop()
+                if len(stack) == 1 and name in ("ImagingId", "Drop"):
+                    values[name] = elem.text
+                elif len(stack) == 2 and stack[-1] in SIZE_TAGS and name in DIMENSION_TAGS:
+                    values[(stack[-1], name)] = float(elem.text)
+                elem.clear()
+                if len(values) == FIELDS_WANTED:
+                    break
+    except (OSError, ET.ParseError, TypeError, ValueError):
+        return XmlRecord(xml)
+
+    if "ImagingId" not in values:
+        return XmlRecord(xml, mtime)
+
+    return XmlRecord(
+        xml,
+        mtime,
+        re.sub(r"\-.*", "", values["ImagingId"]),
+        values.get("Drop"),
+        tuple(values.get(("SizeInMicrons", dimension)) for dimension in DIMENSION_TAGS),
+        tuple(values.get(("SizeInPixels", dimension)) for dimension in DIMENSION_TAGS),
+    )
+
+def parse_xml_chunk(xml_files):
+    with stage("xml_parse"):
+        return [parse_xml(xml) for xml in xml_files]
+
+async def stream_xml_records(xml_files, pool=None, pool_threshold=500, chunk_size=64, prefetch=8):
+    # Large batches are parsed across the image pool, small ones inline
+    if pool is not None and len(xml_files) >= pool_threshold:
+        chunks = (xml_files[i:i + chunk_size] for i in range(0, len(xml_files), chunk_size))
+        inflight = set()
+        try:
+            while True:
+                # Topped up as records are taken, so parsing runs at most prefetch
+                # chunks ahead of the pipeline's bounded queues
+                for chunk in itertools.islice(chunks, prefetch - len(inflight)):
+                    inflight.add(asyncio.ensure_future(pool.run(parse_xml_chunk, chunk)))
+                if not inflight:
+                    break
+                done, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for record in task.result():
+                        metrics.inc("xml_parsed_total", valid=bool(record.inspectionId))
+                        yield record
+        finally:
+            for task in inflight:
+                task.cancel()
+    else:
+        for xml in xml_files:
+            with metrics.time("xml_parse_seconds"):
+                record = parse_xml(xml)
+            metrics.inc("xml_parsed_total", valid=bool(record.inspectionId))
+            yield record
+            await asyncio.sleep(0)
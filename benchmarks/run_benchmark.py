@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import resource
+import argparse
+import tempfile
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "workers"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from formulatrix_uploader import FormulatrixUploader
+from file_worker import EFWorker
+from image_pool import ImagePool
+from metadata_cache import MetadataCache
+from work_journal import WorkJournal
+from database import Database
+from publisher import JobPublisher, MemoryConnection
+from synthetic_data import generate_ef, generate_z, create_fake_ispyb, DROPS_PER_WELL, WELLS_PER_ROW, ROWS, PLATE_TYPE
+
+def image_stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+class TimestampedQueue(list):
+    # Broker queue that records when each image's job arrived
+
+    def __init__(self):
+        super().__init__()
+        self.times = dict()
+
+    def append(self, message):
+        body, _ = message
+        self.times[image_stem(json.loads(body)["image_path"])] = time.perf_counter()
+        super().append(message)
+
+class TimedEFWorker(EFWorker):
+    # Notes when each image's XML has been parsed and enters resolve, so latency
+    # is measured per file rather than from the start of the job
+
+    def __init__(self, started, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started = started
+
+    async def resolve_records(self, batch, records):
+        now = time.perf_counter()
+        for record in records:
+            self.started.setdefault(image_stem(record.xml), now)
+        return await super().resolve_records(batch, records)
+
+class TimedImagePool(ImagePool):
+
+    def __init__(self, max_workers=None, start_method=None):
+        super().__init__(max_workers, start_method)
+        self.latencies = []
+
+    async def run(self, fn, *args, priority=0):
+        start = time.perf_counter()
+        try:
+            return await super().run(fn, *args, priority=priority)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+class BenchmarkUploader(FormulatrixUploader):
+    # Same as the real uploader, but EF workers publish into an in-memory broker
+
+    def __init__(self, broker, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.broker = broker
+        self.started = dict()
+
+    async def create_worker(self, worker_type, config, engine):
+        if worker_type != 'EF':
+            return await super().create_worker(worker_type, config, engine)
+        worker = TimedEFWorker(self.started, config, engine, self.cache, self.pool, JobPublisher(partial(MemoryConnection, self.broker)), self.journal)
+        self.workers.append(worker)
+        return worker
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+def total_size(paths):
+    size = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        else:
+            size += os.path.getsize(path)
+    return size
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"self": round(own, 1), "children": round(children, 1)}
+
+def build_configs(root, args):
+    types = {PLATE_TYPE: {"well_per_row": WELLS_PER_ROW, "drops_per_well": DROPS_PER_WELL}}
+    config_ef = {
+        "upload_dir": os.path.join(root, "upload"),
+        "holding_dir": os.path.join(root, "EF"),
+        "task": "EF",
+        "max_files": 1000000,
+        "max_files_in_batch": args.batch,
+        "priority": 0,
+        "thumb_width": 200,
+        "thumb_height": 150,
+        "save_thumbnail": args.thumbnails,
+        "flip_mode": args.flip_mode,
+        "image_workers": args.workers,
+        "rabbitmq": {"host": "memory"},
+        "journal": {"path": ":memory:"},
+        "types": types,
+        "logging": {},
+    }
+    config_z = {
+        "upload_dir": os.path.join(root, "upload"),
+        "holding_dir": os.path.join(root, "archive"),
+        "task": "Z",
+        "max_files": 1000000,
+        "priority": 10,
+        "transfer": {"checksum": args.checksum},
+        "journal": {"path": ":memory:"},
+        "logging": {},
+    }
+    return config_ef, config_z
+
+async def run(args, root):
+    config_ef, config_z = build_configs(root, args)
+    drops = min(args.drops, len(ROWS) * WELLS_PER_ROW * DROPS_PER_WELL)
+
+    containers, ef_files = generate_ef(config_ef["holding_dir"], config_ef["upload_dir"], args.plates, args.inspections, drops, (args.width, args.height))
+    z_containers, date_dirs = generate_z(config_z["holding_dir"], config_z["upload_dir"], args.z_dates, args.z_barcodes, args.z_slices)
+    session = create_fake_ispyb(containers + z_containers, drops)
+    session.latency = args.db_latency / 1000
+    db = Database.from_config(session, config_ef)
+
+    ef_bytes = total_size(ef_files)
+    z_bytes = total_size(date_dirs)
+    broker = {"jobs": TimestampedQueue()}
+    pool = TimedImagePool(args.workers, args.start_method)
+    uploader = BenchmarkUploader(broker, MetadataCache.from_config(config_ef), pool, journal=WorkJournal())
+    # Spawn the pool workers up front so their start-up is not charged to the first job
+    await pool.warm()
+    pool.latencies.clear()
+    pool.reset_stats()
+
+    report = dict()
+    try:
+        start = time.perf_counter()
+        await uploader.process_job([ef_files], config_ef, db)
+        elapsed = time.perf_counter() - start
+        published = broker["jobs"]
+        report["ef"] = {
+            "files": len(ef_files) // 2,
+            "published": len(published),
+            "bytes": ef_bytes,
+            "seconds": round(elapsed, 3),
+            "files_per_sec": round(len(published) / elapsed, 1),
+            "mb_per_sec": round(ef_bytes / elapsed / 1e6, 1),
+            # From each XML being parsed to its job reaching the broker
+            "publish_latency": latency_summary([t - uploader.started[stem] for stem, t in published.times.items()]),
+            "image_latency": latency_summary(pool.latencies),
+            "stages": pool.stats(),
+            "db_queries": session.queries,
+            "db_limiter": db.stats(),
+        }
+
+        pool.latencies.clear()
+        pool.reset_stats()
+        z_files = sum(len(files) for date_dir in date_dirs for _, _, files in os.walk(date_dir))
+        start = time.perf_counter()
+        await uploader.process_job([date_dirs], config_z, db)
+        elapsed = time.perf_counter() - start
+        report["z"] = {
+            "files": z_files,
+            "bytes": z_bytes,
+            "seconds": round(elapsed, 3),
+            "files_per_sec": round(z_files / elapsed, 1),
+            "mb_per_sec": round(z_bytes / elapsed / 1e6, 1),
+            "transfer_latency": latency_summary(pool.latencies),
+        }
+    finally:
+        uploader.close()
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+def print_report(report):
+    for task in ("ef", "z"):
+        result = report[task]
+        label, latency = ("parsed to published", result["publish_latency"]) if "publish_latency" in result else ("transfer", result["transfer_latency"])
+        print(f"{task.upper()}: {result['files']} file(s), {result['bytes'] / 1e6:.1f} MB in {result['seconds']:.2f}s, "
+              f"{result['files_per_sec']} files/s, {result['mb_per_sec']} MB/s")
+        if latency["count"]:
+            print(f"  per-file latency ({label}) p50 {latency['p50'] * 1000:.1f} ms, p99 {latency['p99'] * 1000:.1f} ms")
+        if result.get("image_latency", {}).get("count"):
+            print(f"  image pool p50 {result['image_latency']['p50'] * 1000:.1f} ms, p99 {result['image_latency']['p99'] * 1000:.1f} ms")
+    print(f"Peak RSS: {report['peak_rss_mb']['self']} MB (uploader), {report['peak_rss_mb']['children']} MB (largest image worker)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the uploader end to end against synthetic data, a fake ISPyB and an in-memory broker")
+    parser.add_argument("--plates", type=int, default=4)
+    parser.add_argument("--inspections", type=int, default=2, help="Inspections per plate")
+    parser.add_argument("--drops", type=int, default=96, help="Drops imaged per inspection")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--batch", type=int, default=250, help="max_files_in_batch")
+    parser.add_argument("--z-dates", type=int, default=2)
+    parser.add_argument("--z-barcodes", type=int, default=4, help="Barcodes per date directory")
+    parser.add_argument("--z-slices", type=int, default=20, help="TIFFs per barcode")
+    parser.add_argument("--workers", type=int, default=4, help="Image pool processes")
+    parser.add_argument("--start-method", choices=["fork", "forkserver", "spawn"], help="Image pool start method (default: the platform's)")
+    parser.add_argument("--flip-mode", default="pil", choices=["pil", "lossless"])
+    parser.add_argument("--thumbnails", action="store_true")
+    parser.add_argument("--checksum", default=None, help="Z transfer checksum, e.g. sha256")
+    parser.add_argument("--db-latency", type=float, default=1.0, help="Simulated ms per DB round trip")
+    parser.add_argument("--dir", help="Work directory (default: a temporary one)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated tree")
+    parser.add_argument("--json", help="Also write the report here")
+    args = parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix="fmlx_bench_")
+    try:
+        report = asyncio.run(run(args, root))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
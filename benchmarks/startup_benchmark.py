@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+
+# Only the standard library at module level: under spawn and forkserver every
+# pool worker imports this module as __mp_main__, and that would be timed too
+WORKERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "workers")
+sys.path.insert(0, WORKERS_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["image_transforms", "shared_worker_functions", "file_worker", "formulatrix_uploader"]
+
+IMPORT_SNIPPET = "import sys, time; sys.path.insert(0, {path!r}); start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+def import_time(module, repeat):
+    # A fresh interpreter per sample, so nothing is already in sys.modules
+    samples = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(path=WORKERS_DIR, module=module)],
+            capture_output=True, text=True, check=True, cwd=WORKERS_DIR,
+        )
+        samples.append(float(result.stdout))
+    return summary(samples)
+
+def summary(samples):
+    return {
+        "min_ms": round(min(samples) * 1000, 1),
+        "median_ms": round(statistics.median(samples) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1),
+    }
+
+async def pool_startup(start_method, workers, image, out_dir, warm):
+    from image_pool import ImagePool
+    from image_transforms import move_file
+
+    config = {"flip_mode": "pil"}
+    xml = f"{os.path.splitext(image)[0]}.xml"
+    pool = ImagePool(workers, start_method)
+    start = time.perf_counter()
+    try:
+        if warm:
+            await pool.warm()
+        ready = time.perf_counter()
+        # One image per worker, as the first batch of a short run would be
+        await asyncio.gather(*(
+            pool.run(move_file, xml, os.path.join(out_dir, f"{start_method}_{n}.jpg"), 1, n, config)
+            for n in range(workers)
+        ))
+        done = time.perf_counter()
+    finally:
+        pool.shutdown()
+    return {"spin_up_s": ready - start, "first_batch_s": done - ready, "total_s": done - start}
+
+def pool_times(start_method, workers, image, out_dir, warm, repeat):
+    runs = [asyncio.run(pool_startup(start_method, workers, image, out_dir, warm)) for _ in range(repeat)]
+    return {key: summary([run[key] for run in runs]) for key in runs[0]}
+
+def run(args, root):
+    from synthetic_data import noise_jpeg
+
+    image = os.path.join(root, "drop.jpg")
+    with open(image, "wb") as f:
+        f.write(noise_jpeg((args.width, args.height)))
+    out_dir = os.path.join(root, "out")
+    os.makedirs(out_dir)
+
+    report = {"imports": {module: import_time(module, args.repeat) for module in MODULES}, "pool": dict()}
+    for start_method in args.start_methods:
+        for warm in (False, True):
+            key = f"{start_method}{'_warm' if warm else ''}"
+            report["pool"][key] = pool_times(start_method, args.workers, image, out_dir, warm, args.repeat)
+    return report
+
+def print_report(report):
+    print("Cold import (fresh interpreter):")
+    for module, times in report["imports"].items():
+        print(f"  {module:<26} median {times['median_ms']:>7.1f} ms  (min {times['min_ms']:.1f}, max {times['max_ms']:.1f})")
+    print("Image pool, start to first image on every worker:")
+    for key, times in report["pool"].items():
+        print(f"  {key:<18} spin-up {times['spin_up_s']['median_ms']:>7.1f} ms, "
+              f"first batch {times['first_batch_s']['median_ms']:>7.1f} ms, total {times['total_s']['median_ms']:>7.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold import time of the worker modules and image pool start-up per start method")
+    parser.add_argument("--repeat", type=int, default=5, help="Samples per measurement")
+    parser.add_argument("--workers", type=int, default=4, help="Image pool processes")
+    parser.add_argument("--start-methods", nargs="+", default=multiprocessing.get_all_start_methods(), choices=multiprocessing.get_all_start_methods())
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--json", help="Also write the report here")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="fmlx_startup_")
+    try:
+        report = run(args, root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,188 @@
+import os
+import io
+import time
+import random
+import asyncio
+from PIL import Image
+from sqlalchemy import create_engine, event, text
+
+ROWS = "ABCDEFGH"
+WELLS_PER_ROW = 12
+DROPS_PER_WELL = 2
+PLATE_TYPE = "CrystalQuickX"
+PROPOSAL = ("cm", 12345)
+VISIT_NUMBER = 1
+XML_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<ImagingResult xmlns="http://www.oppf.ox.ac.uk/opm/ImagingResult">
+  <ImagingId>{inspection}-{imaging}</ImagingId>
+  <Barcode>{barcode}</Barcode>
+  <Drop>{drop}</Drop>
+  <DateImaged>2024-01-01T00:00:00</DateImaged>
+  <SizeInMicrons><Width>{microns_width}</Width><Height>{microns_height}</Height></SizeInMicrons>
+  <SizeInPixels><Width>{width}</Width><Height>{height}</Height></SizeInPixels>
+  <Light>Visible</Light>
+  <FocalLevel>0</FocalLevel>
+</ImagingResult>
+"""
+
+def visit_name():
+    return f"{PROPOSAL[0]}{PROPOSAL[1]}-{VISIT_NUMBER}"
+
+def drop_labels(count):
+    labels = [f"{row}{col}.{drop}" for row in ROWS for col in range(1, WELLS_PER_ROW + 1) for drop in range(1, DROPS_PER_WELL + 1)]
+    return labels[:count]
+
+def noise_jpeg(size, quality=90, seed=0):
+    # Noise compresses about as badly as a real drop image, so file sizes are realistic
+    rng = random.Random(seed)
+    im = Image.frombytes("RGB", size, rng.randbytes(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    im.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+def age(path, seconds=60):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+def generate_ef(holding_dir, upload_dir, plates=4, inspections=2, drops=96, image_size=(1024, 768)):
+    os.makedirs(holding_dir, exist_ok=True)
+    os.makedirs(os.path.join(upload_dir, f"{PROPOSAL[0]}{PROPOSAL[1]}", visit_name()), exist_ok=True)
+    jpeg = noise_jpeg(image_size)
+    containers = []
+    files = []
+    inspection_id = 1000
+    for plate in range(plates):
+        container = {"containerId": plate + 1, "barcode": f"EF{plate:05d}", "inspections": []}
+        for _ in range(inspections):
+            inspection_id += 1
+            container["inspections"].append(inspection_id)
+            for n, drop in enumerate(drop_labels(drops)):
+                stem = os.path.join(holding_dir, f"{container['barcode']}_{inspection_id}_{n:04d}")
+                with open(f"{stem}.jpg", "wb") as f:
+                    f.write(jpeg)
+                with open(f"{stem}.xml", "w") as f:
+                    f.write(XML_TEMPLATE.format(
+                        inspection=inspection_id, imaging=1, barcode=container["barcode"], drop=drop,
+                        microns_width=image_size[0] * 2.5, microns_height=image_size[1] * 2.5,
+                        width=image_size[0], height=image_size[1]))
+                age(f"{stem}.jpg")
+                age(f"{stem}.xml")
+                files.extend([f"{stem}.jpg", f"{stem}.xml"])
+        containers.append(container)
+    return containers, files
+
+def generate_z(archive_dir, upload_dir, dates=2, barcodes=4, slices=20, image_size=(512, 384), first_containerId=1000):
+    os.makedirs(os.path.join(upload_dir, f"{PROPOSAL[0]}{PROPOSAL[1]}", visit_name()), exist_ok=True)
+    rng = random.Random(1)
+    stack = Image.frombytes("L", image_size, rng.randbytes(image_size[0] * image_size[1]))
+    containers = []
+    date_dirs = []
+    for date in range(dates):
+        date_dir = os.path.join(archive_dir, f"2024010{date + 1}")
+        for barcode in range(barcodes):
+            barcode_dir = os.path.join(date_dir, f"Z{date}{barcode:04d}")
+            containers.append({"containerId": first_containerId + len(containers), "barcode": os.path.basename(barcode_dir), "inspections": []})
+            os.makedirs(barcode_dir, exist_ok=True)
+            for z in range(slices):
+                path = os.path.join(barcode_dir, f"slice_{z:03d}.tif")
+                stack.save(path)
+                age(path)
+            with open(os.path.join(barcode_dir, "stack.txt"), "w") as f:
+                f.write(f"slices={slices}\n")
+            age(os.path.join(barcode_dir, "stack.txt"))
+        date_dirs.append(date_dir)
+    return containers, date_dirs
+
+SCHEMA = [
+    "CREATE TABLE Proposal (proposalId INTEGER PRIMARY KEY, proposalCode TEXT, proposalNumber INTEGER)",
+    "CREATE TABLE BLSession (sessionId INTEGER PRIMARY KEY, proposalId INTEGER, visit_number INTEGER)",
+    "CREATE TABLE Shipping (shippingId INTEGER PRIMARY KEY, proposalId INTEGER)",
+    "CREATE TABLE Dewar (dewarId INTEGER PRIMARY KEY, shippingId INTEGER)",
+    "CREATE TABLE Container (containerId INTEGER PRIMARY KEY, dewarId INTEGER, sessionId INTEGER, containerType TEXT, barcode TEXT, blTimeStamp TEXT)",
+    "CREATE TABLE ContainerInspection (containerInspectionId INTEGER PRIMARY KEY, containerId INTEGER)",
+    "CREATE TABLE BLSample (blSampleId INTEGER PRIMARY KEY, containerId INTEGER, location TEXT)",
+    "CREATE INDEX BLSample_container ON BLSample (containerId)",
+]
+
+def create_fake_ispyb(containers, drops):
+    # SQLite stands in for MySQL; concat and date_format are the only MySQL-isms the uploader's queries use
+    engine = create_engine("sqlite://", future=True)
+
+    @event.listens_for(engine, "connect")
+    def register_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function("concat", -1, lambda *args: None if None in args else "".join(map(str, args)))
+        dbapi_connection.create_function("date_format", 2, lambda timestamp, fmt: str(timestamp)[:4])
+
+    with engine.begin() as connection:
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO Proposal VALUES (1, :code, :number)"), {"code": PROPOSAL[0], "number": PROPOSAL[1]})
+        connection.execute(text("INSERT INTO BLSession VALUES (1, 1, :visit)"), {"visit": VISIT_NUMBER})
+        connection.execute(text("INSERT INTO Shipping VALUES (1, 1)"))
+        connection.execute(text("INSERT INTO Dewar VALUES (1, 1)"))
+        sample_id = 0
+        for container in containers:
+            connection.execute(
+                text("INSERT INTO Container VALUES (:id, 1, 1, :type, :barcode, '2024-01-01 00:00:00')"),
+                {"id": container["containerId"], "type": PLATE_TYPE, "barcode": container["barcode"]})
+            for inspection in container["inspections"]:
+                connection.execute(text("INSERT INTO ContainerInspection VALUES (:id, :container)"), {"id": inspection, "container": container["containerId"]})
+            for location in range(1, drops + 1):
+                sample_id += 1
+                connection.execute(text("INSERT INTO BLSample VALUES (:id, :container, :location)"), {"id": sample_id, "container": container["containerId"], "location": str(location)})
+    return FakeSessionMaker(engine)
+
+class FakeSessionMaker:
+    # Quacks like sessionmaker(class_=AsyncSession) for the uploader's usage,
+    # with an optional per-query delay to model the round trip to the DB proxy
+
+    def __init__(self, engine, latency=0.0):
+        self.engine = engine
+        self.latency = latency
+        self.queries = 0
+
+    def __call__(self):
+        return FakeSession(self)
+
+class FakeSession:
+
+    def __init__(self, maker):
+        self.maker = maker
+        self.sync_connection = None
+
+    async def __aenter__(self):
+        self.sync_connection = self.maker.engine.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.sync_connection.close()
+
+    def begin(self):
+        return FakeTransaction(self.sync_connection)
+
+    async def connection(self):
+        return self
+
+    async def invalidate(self):
+        self.sync_connection.invalidate()
+
+    async def execute(self, statement, params=None):
+        self.maker.queries += 1
+        if self.maker.latency:
+            await asyncio.sleep(self.maker.latency)
+        return self.sync_connection.execute(statement, params or {})
+
+class FakeTransaction:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        self.transaction = self.connection.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.transaction.rollback()
+        else:
+            self.transaction.commit()
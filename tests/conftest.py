@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# The workers import each other as top-level modules, as they do when run from app/workers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "workers"))
+# The benchmark's synthetic data and fake ISPyB double as test fixtures
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    # fake_clock(module) replaces module.time.monotonic (or another clock by
+    # name) with one that only moves when the test sets now[0]
+    def install(module, start=0.0, name="monotonic"):
+        now = [start]
+        monkeypatch.setattr(module.time, name, lambda: now[0])
+        return now
+    return install
@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+import database
+from database import AdaptiveLimiter
+
+def test_error_halves_limit_once_per_round(fake_clock):
+    clock = fake_clock(database, 100.0)
+    limiter = AdaptiveLimiter(initial=8, min_limit=1, max_limit=12)
+    limiter.observe(0.5, error=True)
+    assert limiter.limit == 4
+    # Started before that decrease, so it saw the old limit and doesn't count again
+    clock[0] += 0.1
+    limiter.observe(0.5, error=True)
+    assert limiter.limit == 4
+    # Started after it: a new round
+    clock[0] += 1
+    limiter.observe(0.5, error=True)
+    assert limiter.limit == 2
+
+def test_slow_query_shrinks_gently_and_respects_min(fake_clock):
+    clock = fake_clock(database, 100.0)
+    limiter = AdaptiveLimiter(initial=2, min_limit=1, target_latency=0.1, tolerance=2)
+    limiter.observe(0.3)
+    assert limiter.limit == pytest.approx(1.8)
+    for _ in range(20):
+        clock[0] += 10
+        limiter.observe(0.3, error=True)
+    assert limiter.limit == 1
+
+def test_grows_only_when_saturated(fake_clock):
+    fake_clock(database, 100.0)
+    limiter = AdaptiveLimiter(initial=4, max_limit=5, target_latency=0.1)
+    limiter.inflight = 1
+    limiter.observe(0.01)
+    assert limiter.limit == 4
+    limiter.inflight = 3
+    limiter.observe(0.01)
+    assert limiter.limit == pytest.approx(4.25)
+    for _ in range(10):
+        limiter.observe(0.01)
+    assert limiter.limit == 5
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def main():
+        limiter = AdaptiveLimiter(initial=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not limiter.waiters
+        limiter.release()
+        assert limiter.inflight == 0
+        await asyncio.wait_for(limiter.acquire(), 1)
+        assert limiter.inflight == 1
+
+    asyncio.run(main())
+
+def test_waiter_cancelled_after_being_woken_hands_its_slot_back():
+    async def main():
+        limiter = AdaptiveLimiter(initial=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # The slot is handed over, then the waiter is cancelled before it runs
+        limiter.release()
+        assert limiter.inflight == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.inflight == 0
+        await asyncio.wait_for(limiter.acquire(), 1)
+
+    asyncio.run(main())
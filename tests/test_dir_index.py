@@ -0,0 +1,41 @@
+import os
+import dir_index
+from dir_index import DirectoryIndex
+
+def ef_entry(name, is_dir):
+    return not is_dir
+
+def touch(path, data="x"):
+    with open(path, "w") as f:
+        f.write(data)
+
+def test_unchanged_handed_off_file_is_rechecked_once_per_interval(tmp_path, fake_clock):
+    clock = fake_clock(dir_index, 1000.0, "time")
+    path = str(tmp_path / "a.jpg")
+    touch(path)
+    index = DirectoryIndex(str(tmp_path), retry_interval=300)
+    assert index.refresh(ef_entry) == [path]
+    index.mark_emitted([path])
+
+    clock[0] += 10
+    assert index.refresh(ef_entry) == []
+    # Past retry_interval it is stat'ed once, found unchanged, and not offered again
+    clock[0] += 400
+    assert index.refresh(ef_entry) == []
+    assert index.stat(path).emitted == clock[0]
+    # ...nor stat'ed again on the next polls
+    checked = index.stat(path)
+    clock[0] += 5
+    _, scanned = index.scan(ef_entry)
+    assert scanned[path] is checked
+
+def test_changed_handed_off_file_comes_back(tmp_path, fake_clock):
+    clock = fake_clock(dir_index, 1000.0, "time")
+    path = str(tmp_path / "a.jpg")
+    touch(path)
+    index = DirectoryIndex(str(tmp_path), retry_interval=300)
+    index.refresh(ef_entry)
+    index.mark_emitted([path])
+    touch(path, "longer")
+    clock[0] += 400
+    assert index.refresh(ef_entry) == [path]
@@ -0,0 +1,74 @@
+import json
+import asyncio
+from functools import partial
+from file_worker import EFWorker
+from xml_metadata import XmlRecord
+from publisher import JobPublisher, MemoryConnection
+from work_journal import WorkJournal, RESOLVED, TRANSFORMED, PUBLISHED
+from database import Database
+from types import SimpleNamespace
+from synthetic_data import create_fake_ispyb, PLATE_TYPE, WELLS_PER_ROW, DROPS_PER_WELL
+
+def ef_config(tmp_path):
+    return {
+        "holding_dir": str(tmp_path / "EF"),
+        "upload_dir": str(tmp_path / "upload"),
+        "task": "EF",
+        "max_files": 100,
+        "max_files_in_batch": 10,
+        "types": {PLATE_TYPE: {"well_per_row": WELLS_PER_ROW, "drops_per_well": DROPS_PER_WELL}},
+        "logging": {},
+    }
+
+def ef_worker(tmp_path, containers=(), pool=None, journal=None):
+    config = ef_config(tmp_path)
+    db = Database.from_config(create_fake_ispyb(list(containers), 4), config)
+    broker = {"jobs": []}
+    worker = EFWorker(config, db, pool=pool, publisher=JobPublisher(partial(MemoryConnection, broker)), journal=journal or WorkJournal())
+    return worker, broker
+
+def test_bad_imaging_id_drops_only_that_record(tmp_path):
+    worker, _ = ef_worker(tmp_path, [{"containerId": 1, "barcode": "B1", "inspections": [10, 11]}])
+    records = [XmlRecord(f"/EF/{n}.xml", 0, inspection, "A1.1") for n, inspection in enumerate(["10", "1O", "11"])]
+    batch = SimpleNamespace(unique_inspection_id=set())
+    try:
+        resolved = asyncio.run(worker.resolve_records(batch, records))
+    finally:
+        worker.close()
+    assert [datum.record.inspectionId for datum in resolved] == ["10", "11"]
+    assert all(datum.container["containerId"] == 1 and datum.position == 1 for datum in resolved)
+
+class RecordingPool:
+    # Stands in for ImagePool: "transforms" by echoing move_file's arguments back
+    max_workers = 1
+
+    def __init__(self):
+        self.transformed = []
+
+    async def run(self, fn, old_path, new_path, inspectionId, location, *args, priority=0):
+        self.transformed.append(old_path)
+        return old_path, new_path, inspectionId, location
+
+    def stats(self):
+        return {}
+
+def test_resume_picks_up_each_file_after_its_last_finished_stage(tmp_path):
+    journal = WorkJournal()
+    pool = RecordingPool()
+    worker, broker = ef_worker(tmp_path, pool=pool, journal=journal)
+    files = []
+    for name, state in (("resolved", RESOLVED), ("transformed", TRANSFORMED), ("published", PUBLISHED)):
+        files += [f"/EF/{name}.jpg", f"/EF/{name}.xml"]
+        journal.record(f"/EF/{name}.xml", "EF", RESOLVED, {"new_path": f"/visit/{name}.jpg", "inspectionId": "10", "location": 1})
+        journal.record(f"/EF/{name}.xml", "EF", state)
+    try:
+        asyncio.run(worker.process_file(files))
+    finally:
+        worker.close()
+
+    # Resolved: transformed and published; transformed: only published; published: skipped
+    assert pool.transformed == ["/EF/resolved.xml"]
+    assert sorted(json.loads(body)["image_path"] for body, _ in broker["jobs"]) == ["/visit/resolved.jpg", "/visit/transformed.jpg"]
+    assert {path: state for path, (state, _) in journal.states(files[1::2]).items()} == {
+        "/EF/resolved.xml": PUBLISHED, "/EF/transformed.xml": PUBLISHED, "/EF/published.xml": PUBLISHED,
+    }
@@ -0,0 +1,20 @@
+import os
+import asyncio
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+from image_pool import ImagePool
+
+def die():
+    os._exit(1)
+
+def test_pool_recovers_after_a_worker_dies():
+    async def main():
+        pool = ImagePool(max_workers=2, start_method="fork")
+        try:
+            with pytest.raises(BrokenProcessPool):
+                await pool.run(die)
+            assert await pool.run(os.getpid) != os.getpid()
+        finally:
+            pool.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+import pika.exceptions
+from functools import partial
+from publisher import JobPublisher, MemoryChannel, MemoryConnection
+
+class FlakyChannel(MemoryChannel):
+    # Fails one publish, as a dropped connection or a nack would
+
+    def __init__(self, broker, failures):
+        super().__init__(broker)
+        self.failures = failures
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self.failures:
+            raise self.failures.pop()
+        super().basic_publish(exchange, routing_key, body, properties)
+
+class FlakyConnection(MemoryConnection):
+
+    def __init__(self, broker, failures):
+        super().__init__(broker)
+        self.failures = failures
+
+    def channel(self):
+        return FlakyChannel(self.broker, self.failures)
+
+@pytest.mark.parametrize("error", [pika.exceptions.NackError([]), ConnectionResetError(), RuntimeError("unexpected")])
+def test_failed_publish_is_retried_and_nothing_is_lost(error):
+    broker = dict()
+    failures = [error]
+    publisher = JobPublisher(partial(FlakyConnection, broker, failures), batch_size=10, flush_interval=0.01, retry_delay=0.01)
+
+    async def main():
+        for n in range(50):
+            await publisher.publish({"n": n}, f"job-{n}")
+        return await publisher.flush(5)
+
+    try:
+        assert asyncio.run(main())
+    finally:
+        publisher.close()
+    assert publisher.outstanding == 0
+    assert publisher.retries == 1
+    assert [properties.message_id for _, properties in broker["jobs"]] == [f"job-{n}" for n in range(50)]
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+import retry_queue
+from retry_queue import RetryQueue
+
+def test_backoff_doubles_up_to_max_delay():
+    queue = RetryQueue(base_delay=10, max_delay=50, jitter=0)
+    assert [queue.delay(attempts) for attempts in range(1, 6)] == [10, 20, 40, 50, 50]
+
+def test_rescheduled_entry_is_skipped_when_popped(fake_clock):
+    clock = fake_clock(retry_queue)
+    queue = RetryQueue(base_delay=10, jitter=0)
+    queue.schedule("/holding/nosession/a.xml", "nosession")
+    queue.schedule("/holding/nosession/a.xml", "nosession")
+    assert len(queue.heap) == 2
+    # The first heap item (due at 10) was superseded by the reschedule (due at 20)
+    clock[0] = 15
+    assert queue.pop_due(10) == []
+    clock[0] = 25
+    due = queue.pop_due(10)
+    assert [(path, entry.attempts) for path, entry in due] == [("/holding/nosession/a.xml", 2)]
+    assert queue.heap == []
+
+def test_discarded_entry_is_never_popped(fake_clock):
+    clock = fake_clock(retry_queue)
+    queue = RetryQueue(base_delay=10, jitter=0)
+    queue.schedule("a.xml", "nosession")
+    queue.schedule("b.xml", "nosample")
+    queue.discard("a.xml")
+    clock[0] = 100
+    assert [path for path, _ in queue.pop_due(10)] == ["b.xml"]
+    assert queue.next_due() is None
+
+def test_attempts_follow_the_file_between_parking_dirs(fake_clock):
+    fake_clock(retry_queue)
+    queue = RetryQueue(base_delay=10, jitter=0)
+    queue.schedule("/holding/nosession/a.xml", "nosession")
+    queue.schedule("/holding/nosample/a.xml", "nosample", previous="/holding/nosession/a.xml")
+    assert list(queue.entries) == ["/holding/nosample/a.xml"]
+    assert queue.entries["/holding/nosample/a.xml"].attempts == 2
+
+def test_gives_up_after_max_attempts(fake_clock):
+    fake_clock(retry_queue)
+    queue = RetryQueue(base_delay=1, jitter=0, max_attempts=2)
+    for _ in range(3):
+        queue.schedule("a.xml", "nosession")
+    assert len(queue) == 0
+    assert queue.given_up == 1
+
+def test_settle_reschedules_only_untouched_entries(fake_clock):
+    clock = fake_clock(retry_queue)
+    queue = RetryQueue(base_delay=10, jitter=0)
+    for path in ("a.xml", "b.xml", "c.xml"):
+        queue.schedule(path, "nosession")
+    clock[0] = 10
+    due = queue.pop_due(10)
+    queue.discard("a.xml")
+    queue.schedule("b.xml", "nosample")
+    queue.settle(due)
+    assert {path: (entry.reason, entry.attempts) for path, entry in queue.entries.items()} == {
+        "b.xml": ("nosample", 2),
+        "c.xml": ("nosession", 2),
+    }
+
+def test_batches_wakes_for_an_earlier_entry_and_stops():
+    async def main():
+        queue = RetryQueue(base_delay=0.01, jitter=0)
+        got = []
+
+        async def consume():
+            async for batch in queue.batches(10):
+                got.extend(path for path, _ in batch)
+                for path, _ in batch:
+                    queue.discard(path)
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.01)
+        queue.schedule("a.xml", "nosession")
+        await asyncio.sleep(0.1)
+        queue.stop()
+        await asyncio.wait_for(task, 1)
+        return got
+
+    assert asyncio.run(main()) == ["a.xml"]
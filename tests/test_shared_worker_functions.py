@@ -0,0 +1,24 @@
+import asyncio
+import shared_worker_functions
+from shared_worker_functions import fs_memo, make_dirs
+
+def test_dirs_are_made_once_per_batch_whatever_other_batches_do(monkeypatch):
+    made = []
+
+    async def create_dirs(path, config):
+        made.append(path)
+        await asyncio.sleep(0)
+        return True
+
+    monkeypatch.setattr(shared_worker_functions, "create_dirs", create_dirs)
+
+    async def main():
+        first = fs_memo()
+        await asyncio.gather(*(make_dirs("/visit/a", {}, first) for _ in range(10)))
+        # Another batch starting (or finishing) leaves the first batch's memo alone
+        second = fs_memo()
+        await make_dirs("/visit/a", {}, second)
+        await make_dirs("/visit/a", {}, first)
+
+    asyncio.run(main())
+    assert made == ["/visit/a", "/visit/a"]
@@ -0,0 +1,118 @@
+import os
+import time
+import asyncio
+from work_claims import WorkClaims
+from directory_watcher import HoldingDirWatcher
+
+def touch(path):
+    with open(path, "w") as f:
+        f.write("x")
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+def stem(path):
+    return os.path.splitext(path)[0]
+
+def test_each_pair_is_claimed_by_exactly_one_instance(tmp_path):
+    holding = str(tmp_path)
+    files = []
+    for n in range(5):
+        for ext in (".jpg", ".xml"):
+            files.append(os.path.join(holding, f"{n}{ext}"))
+            touch(files[-1])
+    a = WorkClaims(holding, "a")
+    b = WorkClaims(holding, "b")
+    a.start()
+    b.start()
+    won_a = a.claim_files(files[:6], stem)
+    won_b = b.claim_files(files, stem)
+    assert len(won_a) == 6
+    assert len(won_b) == 4
+    assert {os.path.basename(f) for f in won_a}.isdisjoint(os.path.basename(f) for f in won_b)
+
+def test_release_returns_unfinished_work(tmp_path):
+    holding = str(tmp_path)
+    path = os.path.join(holding, "a.jpg")
+    touch(path)
+    claims = WorkClaims(holding, "a")
+    claims.start()
+    claimed = claims.claim_files([path], stem)
+    assert not os.path.exists(path)
+    assert claims.release(claimed) == 1
+    assert os.path.exists(path)
+
+def test_stale_lease_is_reclaimed_exactly_once(tmp_path):
+    holding = str(tmp_path)
+    a = WorkClaims(holding, "a", lease_timeout=60)
+    b = WorkClaims(holding, "b", lease_timeout=60)
+    a.start()
+    b.start()
+
+    dead = WorkClaims(holding, "dead", lease_timeout=60)
+    dead.start()
+    path = os.path.join(holding, "a.jpg")
+    touch(path)
+    dead.claim_files([path], stem)
+    age(dead.lease_path, 120)
+
+    assert a.reclaim_dead() + b.reclaim_dead() == 1
+    assert os.path.exists(path)
+    assert sorted(os.listdir(a.claims_dir)) == ["a", "a.lease", "b", "b.lease"]
+
+def test_live_lease_is_left_alone(tmp_path):
+    holding = str(tmp_path)
+    a = WorkClaims(holding, "a", lease_timeout=60)
+    a.start()
+    busy = WorkClaims(holding, "busy", lease_timeout=60)
+    busy.start()
+    path = os.path.join(holding, "a.jpg")
+    touch(path)
+    busy.claim_files([path], stem)
+
+    assert a.reclaim_dead() == 0
+    assert os.path.exists(os.path.join(busy.staging_dir, "a.jpg"))
+
+def test_half_finished_reclaim_of_a_dead_reclaimer_is_picked_up(tmp_path):
+    holding = str(tmp_path)
+    a = WorkClaims(holding, "a", lease_timeout=60)
+    a.start()
+    # "b" renamed dead's staging dir to claim it, then died itself
+    taken = os.path.join(a.claims_dir, "dead.reclaim-b")
+    os.makedirs(taken)
+    touch(os.path.join(taken, "a.jpg"))
+    touch(os.path.join(a.claims_dir, "b.lease"))
+    age(os.path.join(a.claims_dir, "b.lease"), 120)
+
+    assert a.reclaim_dead() == 1
+    assert os.path.exists(os.path.join(holding, "a.jpg"))
+    assert not os.path.exists(taken)
+
+def test_released_work_is_not_claimed_again_straight_away(tmp_path):
+    holding = str(tmp_path)
+    for name in ("a.jpg", "a.xml"):
+        touch(os.path.join(holding, name))
+        age(os.path.join(holding, name), 60)
+    claims = WorkClaims(holding, "a")
+    claims.start()
+    watcher = HoldingDirWatcher(
+        holding, lambda name, is_dir: not is_dir and not name.startswith("."), lambda path: True,
+        group=stem, poll_interval=0.02, settle_interval=0.01, ignore=claims.returned)
+
+    async def main():
+        batches = 0
+        async def consume():
+            nonlocal batches
+            # Every batch fails and its files go straight back to the holding dir
+            async for batch in watcher.batches():
+                batches += 1
+                claims.release(claims.claim_files(batch, stem))
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.5)
+        watcher.stop()
+        await task
+        return batches
+
+    assert asyncio.run(main()) == 1
+    assert claims.released == {}
@@ -0,0 +1,68 @@
+import os
+from work_journal import WorkJournal, journal_key, DISCOVERED, RESOLVED, PUBLISHED, CLEANED
+from formulatrix_uploader import FormulatrixUploader
+
+def test_staged_paths_are_keyed_on_the_holding_dir():
+    assert journal_key("/holding/.claims/a/x.xml") == "/holding/x.xml"
+    assert journal_key("/holding/.claims/a/2024-01-01/CP1/f.tif") == "/holding/2024-01-01/CP1/f.tif"
+    assert journal_key("/holding/x.xml") == "/holding/x.xml"
+
+def test_states_are_shared_between_staged_and_holding_paths():
+    journal = WorkJournal()
+    journal.record("/holding/.claims/a/x.xml", "EF", RESOLVED, {"new_path": "/visit/x.jpg"})
+    assert journal.states(["/holding/x.xml", "/holding/.claims/b/x.xml"]) == {
+        "/holding/x.xml": (RESOLVED, {"new_path": "/visit/x.jpg"}),
+        "/holding/.claims/b/x.xml": (RESOLVED, {"new_path": "/visit/x.jpg"}),
+    }
+
+def test_released_unfinished_pair_is_resumed_once_per_interval(tmp_path):
+    holding = str(tmp_path)
+    for name in ("a.jpg", "a.xml", "b.jpg", "b.xml"):
+        with open(os.path.join(holding, name), "w") as f:
+            f.write("x")
+    journal = WorkJournal()
+    # a was worked on in a staging dir and released; b was published
+    journal.record(os.path.join(holding, ".claims", "i1", "a.xml"), "EF", DISCOVERED)
+    journal.record(os.path.join(holding, ".claims", "i1", "b.xml"), "EF", PUBLISHED)
+    uploader = FormulatrixUploader(journal=journal)
+    config = {"task": "EF", "holding_dir": holding}
+
+    expected = [os.path.join(holding, "a.jpg"), os.path.join(holding, "a.xml")]
+    assert uploader.unfinished(config, 300) == []
+    assert uploader.unfinished(config) == expected
+    # Offered now, so not again until retry_interval has passed
+    assert uploader.unfinished(config, 0.5) == []
+    assert uploader.unfinished(config, -1) == expected
+
+def test_prune_drops_only_rows_that_cant_cause_a_redo(tmp_path):
+    holding = str(tmp_path)
+    here = {name: os.path.join(holding, f"{name}.xml") for name in ("settled", "offered", "unfinished", "recent")}
+    for path in here.values():
+        with open(path, "w") as f:
+            f.write("x")
+    journal = WorkJournal(retention=60)
+    journal.record("/gone/cleaned.tif", "Z", CLEANED)
+    journal.record("/gone/unfinished.xml", "EF", DISCOVERED)
+    journal.record(here["settled"], "EF", PUBLISHED)
+    journal.record(here["offered"], "EF", PUBLISHED)
+    journal.record(here["unfinished"], "EF", RESOLVED)
+    journal.flush()
+    journal.db.execute("UPDATE files SET updated = updated - 3600")
+    journal.record(here["recent"], "EF", PUBLISHED)
+
+    journal.prune(lambda path: path != here["offered"])
+    assert set(journal.states(["/gone/cleaned.tif", "/gone/unfinished.xml", *here.values()])) == {
+        here["offered"], here["unfinished"], here["recent"],
+    }
+
+def test_prune_checks_a_bounded_batch_per_call():
+    journal = WorkJournal(retention=60, prune_batch=2)
+    for n in range(5):
+        journal.record(f"/gone/{n}.xml", "EF", DISCOVERED)
+    journal.flush()
+    journal.db.execute("UPDATE files SET updated = updated - 3600")
+    remaining = []
+    for _ in range(3):
+        journal.prune()
+        remaining.append(len(journal.unfinished("EF")))
+    assert remaining == [3, 1, 0]
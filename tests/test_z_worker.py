@@ -0,0 +1,24 @@
+import os
+import asyncio
+from file_worker import ZWorker
+from image_pool import ImagePool
+from work_journal import WorkJournal
+from database import Database
+from synthetic_data import generate_z, create_fake_ispyb, visit_name, PROPOSAL
+
+def test_stacks_move_into_their_containers_visit_and_unknown_barcodes_stay(tmp_path):
+    upload = str(tmp_path / "upload")
+    containers, date_dirs = generate_z(str(tmp_path / "archive"), upload, dates=1, barcodes=2, slices=2, image_size=(16, 16))
+    known, unknown = containers
+    config = {"holding_dir": str(tmp_path / "archive"), "upload_dir": upload, "task": "Z", "logging": {}}
+    pool = ImagePool(max_workers=1, start_method="fork")
+    worker = ZWorker(config, Database.from_config(create_fake_ispyb([known], 0), config), pool=pool, journal=WorkJournal())
+    try:
+        asyncio.run(worker.process_file(date_dirs))
+    finally:
+        pool.shutdown()
+
+    target = os.path.join(upload, f"{PROPOSAL[0]}{PROPOSAL[1]}", visit_name(), "tmp", known["barcode"])
+    assert sorted(os.listdir(target)) == ["slice_000.tif", "slice_001.tif", "stack.txt"]
+    assert not os.path.exists(os.path.join(date_dirs[0], known["barcode"]))
+    assert len(os.listdir(os.path.join(date_dirs[0], unknown["barcode"]))) == 3